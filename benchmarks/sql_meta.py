@@ -0,0 +1,84 @@
+"""Compares sql_meta() with the regex pipeline it replaced on generated
+   model files (~0.5MB each). Run from the repository root:
+
+     PYTHONPATH=src python benchmarks/sql_meta.py [repeat]
+"""
+import os
+import re
+import sys
+import tempfile
+from timeit import repeat
+
+from cicd.utils import sql
+from cicd.utils.log import logger
+from cicd.utils.utils import get_file_contents
+
+
+# regex pipeline of sql_meta before the single-pass lexer (logging removed)
+OR_REPLACE   = re.compile(r'create\s+or\s+replace\s+', re.I)
+IF_NOT_EXISTS= re.compile(r'create\s+if\s+not\s+exists\s+', re.I)
+OBJECT_TYPE  = (r'procedure|function|table|external\s+table|sequence|'
+                r'view|materialized\s+view|file\s+format|stage|pipe|stream|task')
+TYPE_NAME    = re.compile(r'create\s+(or\s+replace\s+)?(if\s+not\s+exists\s+)?'
+                          r'(local\s+|global\s+)?(temp\s+|temporary\s+|volatile\s+)?(transient\s+)?'
+                          r'(?P<o_type>' + OBJECT_TYPE + r')\s+(?P<o_name>[\.\w-]+)', re.I)
+DROP         = re.compile(r'drop\s+(' + OBJECT_TYPE + ')', re.I)
+TYPE_DIR     = re.compile(r'/(?P<dir_type>' + OBJECT_TYPE.replace(r'\s+', '.') + r')s?/')
+
+
+def regex_sql_meta(filename):
+    TYPE_DIR.search(filename)
+    contents = get_file_contents(filename)
+    type_name = TYPE_NAME.search(contents)
+    o_type = type_name.group('o_type').upper().replace(' ', '_')
+    o_name = type_name.group('o_name').upper()
+    easy_ddl = o_type not in ['TABLE', 'STREAM']
+    if not easy_ddl:
+        IF_NOT_EXISTS.search(contents)
+        OR_REPLACE.search(contents)
+        DROP.search(contents)
+    else:
+        OR_REPLACE.search(contents)
+    return (o_name, o_type, easy_ddl, contents)
+
+
+def procedure(or_replace, size=500_000):
+    line = "    result := (SELECT COUNT(*) FROM STAGING.EVENTS WHERE ID = :id AND NOTE = 'x''y');\n"
+    body = line * (size // len(line))
+    create = 'CREATE OR REPLACE' if or_replace else 'CREATE'
+    return (f"{create} PROCEDURE PUBLIC.LOAD_EVENTS(ID NUMBER)\nRETURNS NUMBER\n"
+            f"LANGUAGE SQL\nAS\n$$\nBEGIN\n{body}    RETURN result;\nEND;\n$$;\n")
+
+
+def table(columns=5000):
+    cols = ',\n'.join(f"    COLUMN_{i} VARCHAR(100) COMMENT 'column number {i}'" for i in range(columns))
+    return f"CREATE TABLE IF NOT EXISTS PUBLIC.WIDE_TABLE (\n{cols}\n);\n"
+
+
+CASES = [
+    ('procedure without OR REPLACE', 'procedures', procedure(or_replace=False)),
+    ('table with 5000 columns', 'tables', table()),
+    ('procedure with OR REPLACE', 'procedures', procedure(or_replace=True)),
+]
+
+
+def main(number=20):
+    logger.disabled = True
+    root = tempfile.mkdtemp()
+    print(f"{'case':<30} {'size':>8} {'regex':>9} {'lexer':>9}")
+    for name, folder, contents in CASES:
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+        filename = os.path.join(root, folder, 'object.sql')
+        with open(filename, 'w') as model_file:
+            model_file.write(contents)
+        # the regexes read 'IF' as name of CREATE TABLE IF NOT EXISTS
+        assert regex_sql_meta(filename)[1:3] == sql.sql_meta(filename)[1:3], name
+        timings = []
+        for implementation in (regex_sql_meta, sql.sql_meta):
+            best = min(repeat(lambda: implementation(filename), number=number, repeat=5))
+            timings.append(best / number * 1000)
+        print(f"{name:<30} {len(contents) // 1024:>6}kB {timings[0]:>7.2f}ms {timings[1]:>7.2f}ms")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
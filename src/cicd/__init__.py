@@ -1,7 +1,2 @@
-try:
-    from .utils.log import logger, init_logger
-    init_logger()
-    from .cicd import main
-    cicd = main
-except (RuntimeError, AssertionError) as e:
-    logger.error(e)
+from .client import main
+cicd = main
@@ -1,10 +1,3 @@
 if __name__ == '__main__':
-    try:
-        from cicd.utils.log import logger, init_logger
-        init_logger()
-        from cicd.cicd import main
-        main()
-    except (RuntimeError, AssertionError) as e:
-        logger.error(e)
-        quit(-1)
-    
\ No newline at end of file
+    from cicd.client import main
+    quit(main())
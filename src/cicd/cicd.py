@@ -8,8 +8,14 @@ from .utils.model import model
 from .utils.dwhrepo import repo
 from .utils.log import logger, init_logger, headline
 from .utils.release import release
+from .utils.snowflake import sf
+from .utils.metrics import metrics
+from .utils.query_stats import query_stats
+from .utils.rollback import RollbackPoint
 
 JOBS = {}
+# actions querying the branch database, worth connecting in background
+WARM_UP_ACTIONS = {'prepare', 'deploy', 'migrate', 'sync', 'history', 'compare', 'rollback'}
 
 def register_action(function):
     JOBS[function.__name__] = function.__doc__
@@ -28,7 +34,11 @@ def prepare(args) -> int:
 @register_action
 def deploy(args):
     """Deploys changes from release candidate file."""
-    model.deploy_release(dry_run=args.dry_run)
+    if args.bundle:
+        release.deploy_bundle(args.bundle, dry_run=args.dry_run, resume=args.resume)
+    else:
+        model.deploy_release(dry_run=args.dry_run, targets=args.targets, resume=args.resume,
+                             skip_unchanged=args.skip_unchanged)
 
 @register_action
 def migrate(args):
@@ -39,7 +49,10 @@ def migrate(args):
 @register_action
 def validate(args):
     """Validates all .sql files in model directory"""
-    model.get_all_ddls()
+    if args.merge:
+        model.merge_validation()
+    else:
+        model.validate(shard=args.shard)
 
 @register_action
 def history(args):
@@ -49,12 +62,13 @@ def history(args):
 @register_action
 def clone(args):
     """Clones (or replaces) database based on prod."""
-    model.clone_production(force=args.force)
+    model.clone_production(force=args.force, wait=not args.no_wait)
 
 @register_action
 def sync(args):
     """Syncs unapplied changes from model and releases dirs."""
-    release.sync(dry_run=args.dry_run)
+    release.sync(dry_run=args.dry_run, targets=args.targets, resume=args.resume,
+                 queue=args.queue, skip_unchanged=args.skip_unchanged, coalesce=args.coalesce)
 
 @register_action
 def test_sync(args):
@@ -77,9 +91,52 @@ def diff(args):
 @register_action
 def abandoned(args):
     """Compares active branches and development clones."""
-    release.compare_branches_and_clones()
+    release.compare_branches_and_clones(prune=args.prune, dry_run=args.dry_run,
+                                        force=args.force)
 
-def main():
+@register_action
+def build(args):
+    """Compiles release file(s) into a self-contained bundle."""
+    release.build_bundle(args.bundle or release.DEFAULT_BUNDLE,
+            filename=args.file.name if args.file else None)
+
+@register_action
+def manifest(args):
+    """Creates or refreshes release manifest (releases/MANIFEST)."""
+    release.build_manifest()
+
+@register_action
+def rollback(args):
+    """Restores objects changed by the last release to their previous state."""
+    release.rollback(dry_run=args.dry_run, force=args.force)
+
+@register_action
+def stats(args):
+    """Prints server-side stats (queue, compile, execution) of the last release."""
+    release.print_query_stats()
+
+@register_action
+def status(args):
+    """Shows clone and drop operations still running (clone --no-wait)."""
+    model.print_async_status(wait=args.wait)
+
+@register_action
+def daemon(args):
+    """Serves cicd commands for this repository from a warm process."""
+    from .utils.daemon import Daemon
+    Daemon(_execute).serve()
+
+def _shard(value):
+    """Parses I/N shard argument."""
+    try:
+        i, n = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard has to be given as I/N, not {value}")
+    if not 1 <= i <= n:
+        raise argparse.ArgumentTypeError(f"Shard {value} out of range")
+    return i, n
+
+def get_parser():
     jobs = list(JOBS.keys())
 
     description = """  Git <-> Snowflake sync and automatic deployment. See
@@ -100,8 +157,98 @@ Actions:\n\n"""
     parser.add_argument("-f", "--force", help="Force command without yes/no "
                         "question asked in terminal.", action="store_true")
     parser.add_argument("action",  nargs='+', help="Action to run", choices=jobs)
-    parser.add_argument("--file", action="store", help="Filename for compare action",
+    parser.add_argument("--file", action="store", help="Filename for compare and build actions",
                         type=argparse.FileType('r'), nargs='?')
+    parser.add_argument("--prune", help="Drop clones without a branch (abandoned "
+                        "action).", action="store_true")
+    parser.add_argument("--targets", help="Deploy or sync all deploy_targets "
+                        "databases from config concurrently.", action="store_true")
+    parser.add_argument("--resume", help="Continue failed deploy or sync from the "
+                        "first statement not applied.", action="store_true")
+    parser.add_argument("--queue", help="Sync holding server-side deploy lease, "
+                        "applying all pending releases in one session.", action="store_true")
+    parser.add_argument("--bundle", action="store", help="Bundle file written by build "
+                        "and deployed by deploy action")
+    parser.add_argument("--skip-unchanged", help="Deploy or sync skipping INCLUDEs "
+                        "with definition identical to the server one.", action="store_true")
+    parser.add_argument("--coalesce", help="Sync applying only the latest version of "
+                        "views, functions and procedures included repeatedly.", action="store_true")
+    parser.add_argument("--shard", type=_shard, help="Validate only shard I of N "
+                        "(I/N) of model files.")
+    parser.add_argument("--merge", help="Merge validate --shard results into one "
+                        "report.", action="store_true")
+    parser.add_argument("--no-wait", help="Submit clone and exit without waiting "
+                        "for it (collect it with status action).", action="store_true")
+    parser.add_argument("--wait", help="Wait for operations listed by status "
+                        "action to finish.", action="store_true")
+    return parser
+
+def run(args) -> int:
+    """Runs all the actions requested in args, returns exit code."""
+    metrics.reset()
+    sf.forget_last_altered()
+    RollbackPoint.new_run()
+    # failures before the first action (waiting for a clone, warm up)
+    action = 'setup'
+    try:
+        if _needs_database(args):
+            branch = repo.get_sf_safe_branch()
+            db = sf.get_db_name(branch)
+            try:
+                # clone submitted by clone --no-wait has to finish first
+                sf.wait_async(db)
+            except RuntimeError as e:
+                raise RuntimeError(f"{e}\nOperation on {db} submitted with --no-wait failed, "
+                        f"{', '.join(args.action)} not run.")
+            sf.warm_up(branch)
+        for action in args.action:
+            with metrics.timer('action_seconds', action=action):
+                globals()[action](args)
+    except (RuntimeError, AssertionError) as e:
+        logger.error(e)
+        metrics.inc('failures', action=action)
+        return -1
+    finally:
+        sf.discard_warm_up()
+        if query_stats.pending() and 'stats' not in args.action:
+            _harvest_query_stats()
+        metrics.write()
+    return 0
+
+def _harvest_query_stats() -> None:
+    """Prints server-side stats of statements run (never fails the run)."""
+    try:
+        stats = release.harvest_query_stats()
+    except (RuntimeError, AssertionError) as e:
+        logger.warning(f"Can't read statement stats from QUERY_HISTORY: {e}")
+        return
+    if stats:
+        query_stats.print(stats)
+
+def _needs_database(args) -> bool:
+    """Checks if actions will query the branch database (and warehouse)."""
+    actions = set(args.action) & WARM_UP_ACTIONS
+    if args.dry_run and not args.bundle:
+        # dry-run deploy doesn't connect at all
+        actions.discard('deploy')
+    return bool(actions) and not args.targets
+
+def _execute(argv, stream, isatty) -> int:
+    """Runs a command line forwarded to the daemon."""
+    args = get_parser().parse_args(argv)
+    init_logger(args, stream=stream, isatty=isatty)
+    try:
+        if 'daemon' in args.action:
+            logger.error("Daemon is already running.")
+            return -1
+        return run(args)
+    finally:
+        # nothing else closes the --file handle in a long-lived process
+        if args.file:
+            args.file.close()
+
+def main():
+    parser = get_parser()
 
     if len(sys.argv)==1:
         parser.print_help(sys.stderr)
@@ -110,12 +257,7 @@ Actions:\n\n"""
     args = parser.parse_args()
     init_logger(args)
 
-    try:
-        for action in args.action:
-            globals()[action](args)
-    except (RuntimeError, AssertionError) as e:
-        logger.error(e)
-        quit(-1)
+    return run(args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import socket
+import hashlib
+import tempfile
+from stat import S_ISDIR, S_ISSOCK
+
+DAEMON_ACTION = 'daemon'
+NO_DAEMON_ENV = 'CICD_NO_DAEMON'
+
+
+def find_repo_root(path=None):
+    """Returns the closest parent directory holding .git (or None)."""
+    path = os.path.abspath(path or os.getcwd())
+    while True:
+        if os.path.exists(os.path.join(path, '.git')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def runtime_dir():
+    """Returns per-user directory for daemon sockets, created with mode 0700.
+       Fails if it is not a directory accessible only by the current user."""
+    path = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(),
+                        f"cicd-{os.getuid()}")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    stat = os.lstat(path)
+    if not S_ISDIR(stat.st_mode) or stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        raise RuntimeError(f"{path} has to be a directory owned and accessible only by you.")
+    return path
+
+def socket_path(repo_root):
+    """Returns per-user, per-repository daemon socket path."""
+    digest = hashlib.md5(repo_root.encode()).hexdigest()[:12]
+    return os.path.join(runtime_dir(), f"{digest}.sock")
+
+def forward(argv, repo_root):
+    """Forwards argv to a running daemon and streams back its output.
+       Returns exit code or None if no daemon is listening (or its socket
+       is not owned by the current user)."""
+    try:
+        path = socket_path(repo_root)
+        stat = os.lstat(path)
+    except FileNotFoundError:
+        return None
+    except RuntimeError as e:
+        sys.stderr.write(f"{e} Not using the daemon.\n")
+        return None
+    if not S_ISSOCK(stat.st_mode) or stat.st_uid != os.getuid():
+        sys.stderr.write(f"{path} is not a socket owned by you. Not using the daemon.\n")
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+
+    with sock, sock.makefile('rwb') as channel:
+        request = {'argv': argv, 'cwd': os.getcwd(), 'isatty': sys.stderr.isatty()}
+        channel.write(json.dumps(request).encode() + b'\n')
+        channel.flush()
+        for line in channel:
+            message = json.loads(line)
+            if 'exit' in message:
+                return message['exit']
+            stream = sys.stdout if message.get('stream') == 'stdout' else sys.stderr
+            stream.write(message['data'])
+            stream.flush()
+    # daemon went away in the middle of the action
+    return -1
+
+def main():
+    """Thin `cicd` entry point: uses a warm daemon when one is running,
+       otherwise imports and runs the whole tool in-process."""
+    argv = sys.argv[1:]
+    if argv and DAEMON_ACTION not in argv and not os.environ.get(NO_DAEMON_ENV):
+        repo_root = find_repo_root()
+        if repo_root:
+            code = forward(argv, repo_root)
+            if code is not None:
+                return code
+
+    from .utils.log import logger, init_logger
+    init_logger()
+    try:
+        from .cicd import main as cicd_main
+    except (RuntimeError, AssertionError) as e:
+        logger.error(e)
+        return -1
+    return cicd_main()
@@ -0,0 +1,44 @@
+import os
+import json
+from glob import glob
+from time import time
+
+from .config import config
+from .utils import remove_file
+
+
+class AsyncQuery():
+    """Long running statement (clone, drop) submitted without waiting for
+       its result. Query ID is kept in a local file (one per database), so
+       the result can be collected later by `status` action or another run."""
+
+    ASYNC_DIR = '.async'
+    POLL_MIN  = 1
+    POLL_MAX  = int(config.read_config('async_poll_max', default='30'))
+
+    def __init__(self, db):
+        self.db = db
+        self.path = os.path.join(self.ASYNC_DIR, f"{db}.json")
+
+    @classmethod
+    def pending(cls) -> list:
+        """Returns databases with a submitted operation not collected yet."""
+        return sorted(os.path.basename(path)[:-len('.json')]
+                      for path in glob(os.path.join(cls.ASYNC_DIR, '*.json')))
+
+    def save(self, operation, query_id) -> None:
+        os.makedirs(self.ASYNC_DIR, exist_ok=True)
+        with open(self.path, 'w') as pending:
+            json.dump({'db': self.db, 'operation': operation, 'query_id': query_id,
+                       'submitted': time()}, pending)
+
+    def load(self):
+        """Returns the submitted operation ({db, operation, query_id,
+           submitted}) or None."""
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r') as pending:
+            return json.load(pending)
+
+    def remove(self) -> None:
+        remove_file(self.path)
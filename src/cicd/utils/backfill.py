@@ -0,0 +1,181 @@
+import threading
+from datetime import date
+from decimal import Decimal
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from snowflake.connector.constants import FIELD_ID_TO_NAME
+from snowflake.connector.errors import Error as SfError
+
+from .log import logger
+from .config import config
+from .sql import parse_chunk_hint
+from .metrics import metrics
+from .query_stats import query_stats
+
+
+class Backfill():
+    """Statement split into ranges of a key or date column (`--.CHUNK:
+       TABLE.COLUMN N` hint) run concurrently in a bounded set of sessions.
+       Each chunk commits on its own and is recorded in the release journal,
+       so a resumed release runs only the chunks that did not finish."""
+
+    WORKERS     = int(config.read_config('backfill_workers', default='4'))
+    RETRIES     = int(config.read_config('backfill_retries', default='2'))
+    PLACEHOLDER = '{{CHUNK}}'
+    # Snowflake types of numeric, date and timestamp columns
+    KEY_TYPES   = {'FIXED', 'REAL', 'DATE', 'TIMESTAMP_LTZ', 'TIMESTAMP_NTZ', 'TIMESTAMP_TZ'}
+
+    def __init__(self, statement, hint, journal, i, connect, session_state=(), warehouse=None,
+                 label=None):
+        """`connect` returns a new connection to the release database,
+           session_state are USE / ALTER SESSION statements preceding this
+           one, replayed in every chunk session. Hints are checked up
+           front, see check()."""
+        self.statement = statement
+        self.table, self.column, self.chunks = parse_chunk_hint(hint)
+        self.journal = journal
+        self.i = i
+        self._connect = connect
+        self.session_state = list(session_state)
+        self.warehouse = warehouse
+        self.label = label
+
+    @classmethod
+    def check(cls, statements, hints, cur) -> None:
+        """Checks chunk hints of all the statements before the release runs
+           any: the placeholder, the hint value and the key column type of
+           tables that exist already (tables created by the release are
+           checked when the statement runs)."""
+        for i, hint in sorted(hints.items()):
+            if not hint.get('chunk'):
+                continue
+            if cls.PLACEHOLDER not in statements[i]:
+                raise RuntimeError(f"Statement #{i + 1} has --.CHUNK hint but no "
+                        f"{cls.PLACEHOLDER} placeholder for the range predicate.")
+            table, column, chunks = parse_chunk_hint(hint['chunk'])
+            try:
+                key = cur.describe(config.sql('backfill_key').format(table=table, column=column))[0]
+            except SfError as e:
+                logger.debug(f"Can't check type of {table}.{column} yet: {e}")
+                continue
+            if FIELD_ID_TO_NAME[key.type_code] not in cls.KEY_TYPES:
+                raise RuntimeError(f"Can't split statement #{i + 1} into chunks by {table}.{column} "
+                        f"of type {FIELD_ID_TO_NAME[key.type_code]}, use a numeric, date or "
+                        "timestamp column.")
+
+    def run(self) -> None:
+        predicates = self.journal.chunk_plan(self.i)
+        if predicates is None:
+            predicates = self.plan()
+            self.journal.start_chunks(self.i, predicates)
+        done = self.journal.chunks_done(self.i)
+        pending = [c for c in range(len(predicates)) if c not in done]
+        workers = min(self.WORKERS, len(pending)) or 1
+        logger.info(f"  running statement #{self.i + 1} in {len(predicates)} chunk(s) by "
+                f"{self.table}.{self.column} using {workers} session(s)"
+                + (f", {len(done)} already done" if done else ''))
+
+        local, lock = threading.local(), threading.Lock()
+        connections, finished = [], [len(done)]
+        def run_chunk(c):
+            if not hasattr(local, 'conn'):
+                local.conn = self._session()
+                with lock:
+                    connections.append(local.conn)
+            sql = self.statement.replace(self.PLACEHOLDER, f"({predicates[c]})")
+            tag = query_stats.tag(self.journal.release_hash, self.label, self.i, chunk=c)
+            for attempt in range(self.RETRIES + 1):
+                query_id = None
+                try:
+                    start = perf_counter()
+                    cur = local.conn.cursor()
+                    cur.execute(query_stats.set_tag_sql(tag))
+                    try:
+                        cur.execute(sql)
+                        query_id = cur.sfqid
+                    except SfError as e:
+                        query_id = e.sfqid
+                        raise
+                    finally:
+                        # failed attempts are recorded too
+                        query_stats.record(self.journal.db, query_id, tag)
+                    local.conn.commit()
+                    break
+                except SfError as e:
+                    local.conn.rollback()
+                    metrics.inc('backfill_chunk_failures')
+                    if attempt == self.RETRIES:
+                        logger.error(f"  chunk {c + 1}/{len(predicates)} ({predicates[c]}) failed: {e}")
+                        raise
+                    logger.warning(f"  chunk {c + 1}/{len(predicates)} failed, retrying: {e}")
+            metrics.observe('backfill_chunk_seconds', perf_counter() - start)
+            self.journal.chunk_done(self.i, c)
+            with lock:
+                finished[0] += 1
+                logger.info(f"  chunk {c + 1}/{len(predicates)} done in {perf_counter() - start:.1f}s "
+                        f"({finished[0]}/{len(predicates)})")
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {executor.submit(run_chunk, c): c for c in pending}
+            failed = sorted(futures[future] + 1 for future in as_completed(futures)
+                            if future.exception())
+        finally:
+            executor.shutdown(wait=True)
+            for conn in connections:
+                conn.close()
+        if failed:
+            raise SfError(msg=f"Chunk(s) {', '.join(map(str, failed))} of statement #{self.i + 1} "
+                    f"failed after {self.RETRIES} retries. Finished chunks are kept, "
+                    "rerun with --resume to run the rest.")
+
+    def _session(self):
+        conn = self._connect()
+        cur = conn.cursor()
+        for statement in self.session_state:
+            cur.execute(statement)
+        if self.warehouse:
+            cur.execute(config.sql('use_warehouse').format(warehouse=self.warehouse))
+        return conn
+
+    def plan(self) -> list:
+        """Returns range predicates covering all values of the column (and
+           NULLs) in at most `chunks` chunks."""
+        conn = self._session()
+        try:
+            cur = conn.cursor()
+            cur.execute(config.sql('backfill_bounds').format(table=self.table, column=self.column))
+            low, high = cur.fetchone()
+        finally:
+            conn.close()
+        null_chunk = f"{self.column} IS NULL"
+        if low is None:
+            return [null_chunk]
+        bounds = self.boundaries(low, high, self.chunks)
+        predicates = []
+        for c, (lower, upper) in enumerate(zip(bounds, bounds[1:])):
+            if c == len(bounds) - 2:
+                predicates.append(f"{self.column} >= {self.literal(lower)} "
+                                  f"AND {self.column} <= {self.literal(upper)}")
+            elif lower != upper:
+                predicates.append(f"{self.column} >= {self.literal(lower)} "
+                                  f"AND {self.column} < {self.literal(upper)}")
+        return predicates + [null_chunk]
+
+    @staticmethod
+    def boundaries(low, high, n) -> list:
+        """Splits [low, high] into n ranges of (roughly) equal width."""
+        if isinstance(low, int):
+            return [low + (high - low) * i // n for i in range(n)] + [high]
+        if isinstance(low, (float, Decimal, date)):
+            # date and datetime ranges are timedeltas
+            return [low + (high - low) * i / n for i in range(n)] + [high]
+        raise SfError(msg=f"Can't split column values of type {type(low).__name__} into "
+                "chunks, use a numeric, date or timestamp column.")
+
+    @staticmethod
+    def literal(value) -> str:
+        if isinstance(value, date):
+            return f"'{value.isoformat()}'"
+        return str(value)
@@ -0,0 +1,120 @@
+import io
+import os
+import sys
+import json
+import socket
+import socketserver
+from contextlib import redirect_stdout, redirect_stderr
+
+from .log import logger, init_logger
+from .config import config
+from .snowflake import sf
+from ..client import find_repo_root, socket_path
+
+
+class _ChannelStream(io.TextIOBase):
+    """File-like object forwarding writes to the client as JSON messages."""
+
+    def __init__(self, channel, name, isatty=False):
+        self._channel = channel
+        self._name = name
+        self._isatty = isatty
+
+    def write(self, data):
+        if data:
+            self._channel.write(json.dumps({'stream': self._name, 'data': data}).encode() + b'\n')
+            self._channel.flush()
+        return len(data)
+
+    def isatty(self):
+        return self._isatty
+
+
+class Daemon(socketserver.UnixStreamServer):
+    """Per-repository server keeping repo, model and Snowflake sessions warm."""
+
+    IDLE_TIMEOUT = int(config.read_config('daemon_idle_timeout', default='900'))
+
+    def __init__(self, execute):
+        """`execute(argv, stream, isatty)` runs a single cicd command line
+           and returns its exit code."""
+        self.execute = execute
+        self.repo_root = find_repo_root()
+        self.path = socket_path(self.repo_root)
+        self._idle = False
+        self._claim_socket()
+        super().__init__(self.path, _RequestHandler)
+        os.chmod(self.path, 0o600)
+        self.timeout = self.IDLE_TIMEOUT
+
+    def _claim_socket(self):
+        """Removes stale socket file or fails if other daemon is alive."""
+        if not os.path.exists(self.path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except ConnectionRefusedError:
+            os.remove(self.path)
+            return
+        finally:
+            probe.close()
+        raise RuntimeError(f"Daemon for {self.repo_root} is already running ({self.path}).")
+
+    def serve(self):
+        """Serves requests one by one until idle timeout."""
+        sf.keep_sessions = True
+        logger.info(f"Daemon for {self.repo_root} listening on {self.path}, "
+                f"idle timeout {self.IDLE_TIMEOUT}s.")
+        try:
+            while not self._idle:
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.remove(self.path)
+            sf.close_sessions()
+        logger.info("Daemon stopped after being idle.")
+
+    def handle_timeout(self):
+        self._idle = True
+
+
+def _reset_logger(install=True):
+    """Drops handlers bound to a client stream (and restores daemon's own)."""
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    if install:
+        init_logger()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        isatty = request.get('isatty', False)
+        out = _ChannelStream(self.wfile, 'stdout', isatty)
+        err = _ChannelStream(self.wfile, 'stderr', isatty)
+
+        cwd, stdin = os.getcwd(), sys.stdin
+        # questions can't be answered over the socket, `yes_or_no` gets EOF
+        sys.stdin = io.StringIO()
+        try:
+            os.chdir(request['cwd'])
+            with redirect_stdout(out), redirect_stderr(err):
+                code = self._execute(request['argv'], err, isatty)
+        finally:
+            sys.stdin = stdin
+            os.chdir(cwd)
+            _reset_logger()
+        self.wfile.write(json.dumps({'exit': code}).encode() + b'\n')
+
+    def _execute(self, argv, stream, isatty):
+        _reset_logger(install=False)
+        try:
+            return self.server.execute(argv, stream, isatty)
+        except SystemExit as e:
+            # argparse errors and --help
+            return e.code if isinstance(e.code, int) else -1
+        except Exception as e:
+            logger.exception(e)
+            return -1
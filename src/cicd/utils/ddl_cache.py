@@ -0,0 +1,71 @@
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+
+from .config import config
+
+
+class DDLCache():
+    """On-disk cache of GET_DDL results: one file per object in a directory
+       per database. An entry is valid while object's LAST_ALTERED doesn't
+       change, least recently used entries are evicted above `ddl_cache_size`
+       megabytes."""
+
+    CACHE_DIR = config.read_config('ddl_cache_dir', default='.ddl_cache')
+    MAX_SIZE  = int(float(config.read_config('ddl_cache_size', default='50')) * 1024 * 1024)
+
+    def __init__(self):
+        # total size of entries, the directory is scanned only when it's unknown
+        self._size = None
+
+    def get(self, db, key, last_altered):
+        """Returns cached DDL of object (TYPE#SCHEMA.NAME key) or None."""
+        path = self._path(db, key)
+        try:
+            with open(path, 'r') as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+        if entry['last_altered'] != str(last_altered):
+            return None
+        # mtime is the last use, for eviction
+        os.utime(path)
+        return entry['ddl']
+
+    def put(self, db, key, last_altered, ddl) -> None:
+        path = self._path(db, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self._size is None:
+            self._size = sum(path.stat().st_size for path in Path(self.CACHE_DIR).glob('*/*.json'))
+        # a replaced entry is counted by the scan too
+        if os.path.exists(path):
+            self._size -= os.path.getsize(path)
+        with open(path, 'w') as entry_file:
+            json.dump({'key': key, 'last_altered': str(last_altered), 'ddl': ddl}, entry_file)
+        self._size += os.path.getsize(path)
+        if self._size > self.MAX_SIZE:
+            self._evict()
+
+    def clear(self, db) -> None:
+        """Removes all entries of database (e.g. when it's recreated)."""
+        shutil.rmtree(os.path.join(self.CACHE_DIR, db), ignore_errors=True)
+        self._size = None
+
+    def _path(self, db, key):
+        return os.path.join(self.CACHE_DIR, db, hashlib.md5(key.encode()).hexdigest() + '.json')
+
+    def _evict(self) -> None:
+        """Removes least recently used entries until cache fits MAX_SIZE."""
+        entries = []
+        for path in Path(self.CACHE_DIR).glob('*/*.json'):
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.MAX_SIZE:
+                break
+            path.unlink()
+            total -= size
+        self._size = total
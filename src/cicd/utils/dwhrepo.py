@@ -2,14 +2,26 @@ import os
 import re
 from datetime import datetime
 
-from git import Repo, InvalidGitRepositoryError
+from git import Repo, Git, InvalidGitRepositoryError, GitCommandError
+from gitdb.exc import BadName
+from gitdb.util import hex_to_bin
 
 from .log import logger
 from .config import config
+from .metrics import metrics
+
+
+class _CountedGit(Git):
+    """git command wrapper counting git subprocess calls."""
+
+    def execute(self, command, *args, **kwargs):
+        metrics.inc('git_commands', command=command[1] if len(command) > 1 else command[0])
+        return super().execute(command, *args, **kwargs)
 
 
 class DWHRepo(Repo):
     """Wrapper class git git.Repo to handle DWH repository specific tasks."""
+    GitCommandWrapperType = _CountedGit
     MODEL_DIR = None
     SF_SAFE   = re.compile(r'\W')
 
@@ -41,6 +53,65 @@ class DWHRepo(Repo):
                 logger.info("  [{}] {}".format(d.change_type, d.b_path))
         return files
     
+    def get_tracked_files(self, prefix='', suffix='.sql', commit='HEAD'):
+        """Returns {file: blob SHA} of files under prefix in commit."""
+        files = {}
+        for entry in self.git.ls_tree('-r', '-z', commit, '--', prefix).split('\0'):
+            if entry:
+                meta, filename = entry.split('\t', 1)
+                if filename.endswith(suffix):
+                    files[filename] = meta.split()[2]
+        return files
+
+    def get_blob_contents(self, blob) -> str:
+        """Returns contents of blob (SHA) read from object database."""
+        return self.odb.stream(hex_to_bin(blob)).read().decode('utf-8')
+
+    def grep_files(self, text, commit, prefix=''):
+        """Returns files under prefix in commit containing text (ignoring case)."""
+        try:
+            found = self.git.grep('-l', '-i', '-F', text, commit, '--', prefix)
+        except GitCommandError:
+            # git grep exits with 1 when nothing was found
+            return []
+        return [line.split(':', 1)[1] for line in found.splitlines()]
+
+    def get_files_in_added_order(self, prefix=''):
+        """Returns files under prefix in order they were added to history."""
+        files = self.git.log('--diff-filter=A', '--name-only', '--format=', '--reverse',
+                '--', prefix).splitlines()
+        return list(dict.fromkeys(files))
+
+    def has_commit(self, commit) -> bool:
+        """Checks if commit is in local history."""
+        try:
+            self.commit(commit)
+            return True
+        except (ValueError, BadName):
+            return False
+
+    def get_file_blob(self, filename, commit='HEAD'):
+        """Returns SHA of file contents at commit (a tree lookup, history is
+           not walked), None if file or commit is not there."""
+        try:
+            return (self.commit(commit).tree / filename).hexsha
+        except (KeyError, ValueError, BadName):
+            return None
+
+    def get_uncommitted_files(self, filenames) -> list:
+        """Returns files of filenames that are untracked or have uncommitted
+           changes."""
+        entries = iter(self.git.status('--porcelain', '-z', '--untracked-files=all', '--ignored',
+                                       '--', *filenames).split('\0'))
+        files = []
+        for entry in entries:
+            if entry:
+                files.append(entry[3:])
+                if entry[0] in 'RC':
+                    # source path of a rename or copy follows
+                    next(entries, None)
+        return files
+
     def get_file_contents_by_commit(self, filename, commit):
         return self.git.show(f"{commit}:{filename}")
 
@@ -74,9 +145,9 @@ class DWHRepo(Repo):
             if not self.is_model_clean():
                 raise RuntimeError(f'{self.MODEL_DIR} not clean! Commit your changes.')
 
-    def commit_release(self, release_file):
-        """Adds release_file to stage and commits it."""
-        self.index.add([release_file])
+    def commit_release(self, *files):
+        """Adds release file (and other files given) to stage and commits it."""
+        self.index.add(list(files))
         self.index.commit('(DWH new release)')
         try:
             self.remote(name='origin').push()
@@ -100,11 +171,12 @@ class DWHRepo(Repo):
         return model_clean
 
     def get_dev_branches(self):
-        """Returns a list of development branches and."""
+        """Returns a set of development branches (local and remote tracking)."""
         self.git.fetch("--all")
-        branches = []
-        for branch in self.branches:
-            branches.append(self.get_sf_safe_branch(branch.name))
+        branches = {self.get_sf_safe_branch(branch.name) for branch in self.branches}
+        for remote in self.remotes:
+            branches.update(self.get_sf_safe_branch(ref.remote_head)
+                    for ref in remote.refs if ref.remote_head != 'HEAD')
         return branches
     
     def get_last_commit_sha(self) -> str:
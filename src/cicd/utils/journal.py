@@ -0,0 +1,147 @@
+import os
+import json
+import threading
+
+from .log import logger
+from .config import config
+from .utils import hexDigest, remove_file
+
+
+class Journal():
+    """Statement level checkpoints of a running release, used to resume
+       a failed release from the first statement that was not applied.
+
+       Journal is kept in a local file (one per database) and optionally in
+       a server-side table (`journal_table` config key) in target database."""
+
+    JOURNAL_DIR   = '.journal'
+    JOURNAL_TABLE = config.read_config('journal_table', default='')
+
+    def __init__(self, db, statements, connect):
+        """`connect` returns a new connection to db, used for server-side
+           journal so it's written outside of the release transaction."""
+        self.db = db
+        self.hashes = [hexDigest(statement) for statement in statements]
+        self.release_hash = hexDigest(''.join(self.hashes))
+        self.path = os.path.join(self.JOURNAL_DIR, f"{db}.jsonl")
+        self._connect = connect
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def resume_point(self) -> int:
+        """Returns the number of statements applied by a previous failed run
+           of the same release."""
+        applied = self._read_local()
+        if applied is None and self.JOURNAL_TABLE:
+            applied = self._read_server()
+        if applied is None:
+            logger.info(f"No journal found for {self.db}, running release from the beginning.")
+            return 0
+        logger.info(f"Resuming release in {self.db}: skipping {applied} statement(s) "
+                "already applied.")
+        return applied
+
+    def warn_stale(self) -> None:
+        """Warns if a previous run left a journal behind (it's replaced)."""
+        if os.path.exists(self.path):
+            logger.warning(f"Previous release in {self.db} failed (see {self.path}). "
+                    "Use --resume to continue it instead of running from the beginning.")
+
+    def start(self, applied=0, resume=False) -> None:
+        """Starts (or continues) journal of this release."""
+        if applied or (resume and os.path.exists(self.path)):
+            # kept also with no statement applied, it may hold chunk progress
+            return
+        os.makedirs(self.JOURNAL_DIR, exist_ok=True)
+        with open(self.path, 'w') as journal:
+            journal.write(json.dumps({'db': self.db, 'release': self.release_hash,
+                    'statements': len(self.hashes)}) + '\n')
+        self._server_sql('journal_clear')
+
+    def checkpoint(self, i) -> None:
+        """Records statements up to i (inclusive) as durably applied."""
+        self._append({'statement': i, 'hash': self.hashes[i]})
+        self._server_sql('journal_checkpoint', statement=i, statement_hash=self.hashes[i])
+
+    def start_chunks(self, i, predicates) -> None:
+        """Records range predicates of chunked statement i, a resumed run
+           reuses them (data may have changed since)."""
+        self._append({'statement': i, 'chunks': predicates})
+
+    def chunk_done(self, i, chunk) -> None:
+        """Records chunk of statement i as committed (local journal only)."""
+        self._append({'statement': i, 'chunk': chunk})
+
+    def chunk_plan(self, i):
+        """Returns predicates of chunked statement i from the previous run or None."""
+        plans = [entry['chunks'] for entry in self._entries() if entry.get('statement') == i
+                 and 'chunks' in entry]
+        return plans[-1] if plans else None
+
+    def chunks_done(self, i) -> set:
+        return {entry['chunk'] for entry in self._entries() if entry.get('statement') == i
+                and 'chunk' in entry}
+
+    def _append(self, entry) -> None:
+        # chunks of a statement finish concurrently
+        with self._lock, open(self.path, 'a') as journal:
+            journal.write(json.dumps(entry) + '\n')
+
+    def _entries(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'r') as journal:
+            return [json.loads(line) for line in journal if line.strip()]
+
+    def finish(self) -> None:
+        """Removes journal after release was committed."""
+        remove_file(self.path)
+        self._server_sql('journal_clear')
+        self.close()
+
+    def close(self) -> None:
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def _read_local(self):
+        """Returns number of applied statements from the local journal file."""
+        if not os.path.exists(self.path):
+            return None
+        lines = self._entries()
+        self._assert_same_release(lines[0]['release'])
+        applied = 0
+        for entry in lines[1:]:
+            if 'hash' not in entry:
+                # chunk progress of a statement not applied as a whole
+                continue
+            assert self.hashes[entry['statement']] == entry['hash'], (
+                    f"Statement {entry['statement']} changed since the failed run, can't resume.")
+            applied = entry['statement'] + 1
+        return applied
+
+    def _read_server(self):
+        """Returns number of applied statements from the server-side journal."""
+        rows = self._server_sql('journal_read')
+        if not rows or rows[0][0] is None:
+            return None
+        self._assert_same_release(rows[0][0])
+        return rows[0][1] + 1
+
+    def _assert_same_release(self, release_hash):
+        if release_hash != self.release_hash:
+            raise RuntimeError(f"Release content has changed since the failed run in {self.db}. "
+                    f"Can't resume, remove {self.path} (and journal table rows) to start over.")
+
+    def _server_sql(self, query_id, **kwargs):
+        """Runs journal query on a separate autocommitted connection."""
+        if not self.JOURNAL_TABLE:
+            return None
+        if self._conn is None:
+            self._conn = self._connect()
+        sql = config.sql(query_id).format(JOURNAL_TABLE=self.JOURNAL_TABLE,
+                release=self.release_hash, **kwargs)
+        cur = self._conn.cursor()
+        cur.execute(sql)
+        self._conn.commit()
+        return cur.fetchall() if cur.description else None
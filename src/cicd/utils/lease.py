@@ -0,0 +1,94 @@
+import os
+import socket
+import threading
+import uuid
+from time import sleep, time
+
+from snowflake.connector.errors import Error as SfError
+
+from .log import logger
+from .config import config
+from .snowflake import sf
+
+
+class Lease():
+    """Server-side deploy lock: a single row in `lease_table` in the target
+       database, held by one deployer at a time and expiring after
+       `lease_ttl` seconds unless renewed. While held it's renewed every
+       third of lease_ttl from a heartbeat thread with its own session, so
+       a release file (or backfill) running longer than that keeps it."""
+
+    LEASE_TABLE = config.read_config('lease_table', default='PUBLIC.DWH_DEPLOY_LEASE')
+    LEASE_NAME  = 'deploy'
+    TTL         = int(config.read_config('lease_ttl', default='600'))
+    WAIT        = int(config.read_config('lease_wait', default='1800'))
+    POLL        = 10
+
+    def __init__(self, branch):
+        self.branch = branch
+        self.holder = "{}@{}:{}:{}".format(config.read_user_config('user'),
+                socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def __enter__(self):
+        self.acquire()
+        self._heartbeat = threading.Thread(target=self._beat, name='lease-heartbeat', daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._heartbeat.join()
+        self.release()
+
+    def _beat(self) -> None:
+        """Renews the lease until stopped, in a session of its own (release
+           session is busy and inside a transaction)."""
+        conn = sf.connect(self.branch)
+        try:
+            while not self._stop.wait(max(self.TTL // 3, 1)):
+                try:
+                    if not self._run('lease_renew', conn=conn, ttl=self.TTL)[0][0]:
+                        self.lost = True
+                        logger.error("Deploy lease was lost (expired and taken by other deployer).")
+                        return
+                    logger.debug("Deploy lease renewed.")
+                except SfError as e:
+                    # next beat retries, the lease is valid until it expires
+                    logger.warning(f"Deploy lease renewal failed: {e}")
+        finally:
+            conn.close()
+
+    def acquire(self) -> None:
+        """Waits (up to lease_wait seconds) until the lease is free and takes it."""
+        self._run('lease_init')
+        deadline = time() + self.WAIT
+        while not self._run('lease_acquire', ttl=self.TTL)[0][0]:
+            holder, expires_on = self._run('lease_holder')[0]
+            if time() > deadline:
+                raise RuntimeError(f"Deploy lease is still held by {holder}, "
+                        f"gave up after {self.WAIT}s.")
+            if holder:
+                logger.info(f"Deploy lease held by {holder} (until {expires_on:%H:%M:%S}), waiting...")
+            sleep(self.POLL)
+        logger.info(f"Deploy lease acquired by {self.holder}.")
+
+    def renew(self) -> None:
+        """Extends the lease, fails if it was lost (expired and taken over)."""
+        if self.lost or not self._run('lease_renew', ttl=self.TTL)[0][0]:
+            raise RuntimeError("Deploy lease was lost (expired and taken by other deployer).")
+
+    def release(self) -> None:
+        self._run('lease_release')
+        logger.info("Deploy lease released.")
+
+    def _run(self, query_id, conn=None, **kwargs):
+        sql = config.sql(query_id).format(LEASE_TABLE=self.LEASE_TABLE, name=self.LEASE_NAME,
+                holder=self.holder, **kwargs)
+        if conn is None:
+            return sf.run_single_statament(sql, self.branch)
+        cur = conn.cursor()
+        cur.execute(sql)
+        return cur.fetchall()
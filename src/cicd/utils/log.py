@@ -5,10 +5,12 @@ from termcolor import colored
 
 logger = logging.getLogger("snowflake.cicd")
 
-def init_logger(args=None):
+def init_logger(args=None, stream=None, isatty=None):
     coloredlogs.install(
             level='DEBUG' if args and args.verbose else 'INFO',
             logger=logger,
+            stream=stream,
+            isatty=isatty,
             fmt='%(asctime)s %(programname)s %(message)s',
             programname='>',
             datefmt='%H:%m:%S',
@@ -0,0 +1,105 @@
+import os
+import json
+import threading
+from time import time, perf_counter
+from contextlib import contextmanager
+
+from .log import logger
+from .config import config
+
+
+class Metrics():
+    """Per-run metrics registry (counters, gauges and timing summaries)
+       written as OpenMetrics textfile and/or JSON when the run ends."""
+
+    TEXTFILE = config.read_config('metrics_textfile', default='')
+    JSON     = config.read_config('metrics_json', default='')
+    PREFIX   = 'cicd_'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Starts a new run (daemon serves many runs from one process)."""
+        with self._lock:
+            self._metrics = {}
+
+    def inc(self, name, value=1, **labels) -> None:
+        """Increments counter."""
+        self._update(name, 'counter', labels, lambda v: (v or 0) + value)
+
+    def set(self, name, value, **labels) -> None:
+        """Sets gauge."""
+        self._update(name, 'gauge', labels, lambda v: value)
+
+    def observe(self, name, value, **labels) -> None:
+        """Adds observation to summary (count and sum)."""
+        self._update(name, 'summary', labels,
+                     lambda v: (v[0] + 1, v[1] + value) if v else (1, value))
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes duration of the block in seconds."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def _update(self, name, kind, labels, update) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metric = self._metrics.setdefault(self.PREFIX + name, {'type': kind, 'samples': {}})
+            metric['samples'][key] = update(metric['samples'].get(key))
+
+    def write(self) -> None:
+        """Writes metrics to configured textfile and JSON paths."""
+        if not self.TEXTFILE and not self.JSON:
+            return
+        self.set('last_run_timestamp_seconds', time())
+        try:
+            if self.TEXTFILE:
+                self._write_atomic(self.TEXTFILE, self.openmetrics())
+            if self.JSON:
+                self._write_atomic(self.JSON, json.dumps(self.summary(), indent=1))
+        except OSError as e:
+            # metrics must never fail the run itself
+            logger.warning(f"Can't write metrics: {e}")
+
+    def openmetrics(self) -> str:
+        """Returns metrics in OpenMetrics text format."""
+        lines = []
+        with self._lock:
+            for name, metric in sorted(self._metrics.items()):
+                lines.append(f"# TYPE {name} {metric['type']}")
+                for key, value in metric['samples'].items():
+                    labels = ','.join(f'{k}="{v}"' for k, v in key)
+                    labels = f"{{{labels}}}" if labels else ''
+                    if metric['type'] == 'counter':
+                        lines.append(f"{name}_total{labels} {value}")
+                    elif metric['type'] == 'summary':
+                        lines.append(f"{name}_count{labels} {value[0]}")
+                        lines.append(f"{name}_sum{labels} {value[1]}")
+                    else:
+                        lines.append(f"{name}{labels} {value}")
+        lines.append("# EOF")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> dict:
+        """Returns metrics as a JSON serializable dictionary."""
+        with self._lock:
+            return {name: {'type': metric['type'],
+                           'samples': [{'labels': dict(key), 'value': value}
+                                       for key, value in metric['samples'].items()]}
+                    for name, metric in sorted(self._metrics.items())}
+
+    @staticmethod
+    def _write_atomic(path, contents) -> None:
+        """Replaces file at once, so a scraper never reads it half written."""
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as metrics_file:
+            metrics_file.write(contents)
+        os.replace(tmp, path)
+
+metrics = Metrics()
@@ -1,15 +1,19 @@
 import shutil
 import os
 import re
+import json
+import hashlib
 from pathlib import Path
 
 from .log import logger, is_debug
 from .dwhrepo import repo
 from .snowflake import sf
 from .release import release
-from .sql import print_sql, sql_meta, get_diff_sql, statement_cleanup
+from .sql import print_sql, sql_meta, get_diff_sql, statement_cleanup, split_sql_hints, log_statement_hints
 from .utils import get_file_contents
 from .config import config
+from .metrics import metrics
+from .async_query import AsyncQuery
 
 
 class Model():
@@ -18,19 +22,32 @@ class Model():
     MODEL_DIR    = config.read_config('model_dir', default='model')
     EXTENSIONS   = re.compile(r'.*(\.sql)|(\.vw)|(\.tbl)$', re.I)
     DIFF_DIR     = ".diff"
+    VALIDATE_DIR = ".validate"
 
     def __init__(self):
-        self.sf_safe_branch  = repo.get_sf_safe_branch()
+        self._ddl_cache = {}
+
+    @property
+    def sf_safe_branch(self):
+        """Active branch (read on every use, as daemon outlives checkouts)."""
+        return repo.get_sf_safe_branch()
 
     def prepare_release_candidate(self, force):
         """Prepares a release candidate file (if missing)."""
         repo.assert_repo()
         commit_hash = release.get_base_commit(self.sf_safe_branch)
-        release.check_release_dir_clean(base_commit=commit_hash)
+        release.check_release_dir_clean(base_commit=commit_hash, branch=self.sf_safe_branch)
 
-        files = repo.get_changed_files(index=commit_hash,
-                prefix=Model.MODEL_DIR)
+        deployed = (release.deployed_object_hashes(self.sf_safe_branch)
+                    if release.OBJECT_HASH_TABLE else None)
+        if deployed:
+            logger.info(f"Comparing model files with hashes in {release.OBJECT_HASH_TABLE}:")
+            files, base_commits = release.get_changed_objects(deployed)
+        else:
+            files, base_commits = repo.get_changed_files(index=commit_hash,
+                    prefix=Model.MODEL_DIR), {}
 
+        metrics.set('prepare_changed_files', len(files))
         if len(files) == 0:
             logger.info(f"No changes in {Model.MODEL_DIR} dir to prepare release candidate "
                     "file. Preparing empty file.")
@@ -43,32 +60,96 @@ class Model():
         branch = repo.get_branch()
 
         release_candidate_sql = f"--.Release candidate file, branch: {branch}\n\n"
-        for change in files.values():
-            release_candidate_sql += Model._change_into_release_entry(change, commit_hash)
+        for filename, change in files.items():
+            release_candidate_sql += Model._change_into_release_entry(change,
+                    base_commits.get(filename, commit_hash))
 
         release.save_release_candidate_file(release_candidate_sql, branch)
         logger.debug("Release candidate file contents:\n" + release_candidate_sql)
 
-    def deploy_release(self, dry_run=True):
+    def deploy_release(self, dry_run=True, targets=False, resume=False, skip_unchanged=False):
         release_sql = release.prepare_release_file()
-        deploy_sql = release.release_file_to_sql(release_sql)
+        dbs = sf.get_targets() if targets else None
+        if skip_unchanged and (dbs or resume):
+            # resumed release has to consist of the very same statements
+            logger.warning("--skip-unchanged is not supported with --targets and --resume, ignoring it.")
+            skip_unchanged = False
+        server_ddls = sf.get_ddl_fingerprints(self.sf_safe_branch) if skip_unchanged else None
+        deploy_sql = release.release_file_to_sql(release_sql, server_ddls)
 
         if is_debug():
             print_sql(deploy_sql)
         if dry_run:
             if not is_debug():
                 print_sql(deploy_sql)
+            log_statement_hints(*split_sql_hints(deploy_sql), config.read_config('warehouse'))
+            if dbs:
+                logger.info(f"Release would be deployed to: {', '.join(dbs)}.")
             logger.info("Skipping SQL execution due to --dry-run.")
             return
 
-        sf.perform_release(deploy_sql, self.sf_safe_branch)
-        release.save_release(release_sql)
+        if not dbs:
+            sf.perform_release(deploy_sql, self.sf_safe_branch, resume=resume,
+                               label=release.RELEASE_CANDIDATE)
+            release.save_release(release_sql)
+            return
+
+        logger.info(f"Deploying release to {len(dbs)} target(s):")
+        failed = sf.fan_out(dbs, lambda db: sf.perform_release(deploy_sql, None, db=db,
+                resume=resume, label=release.RELEASE_CANDIDATE))
+        succeeded = [db for db in dbs if db not in failed]
+        if succeeded:
+            release.save_release(release_sql, dbs=succeeded)
+        if failed:
+            raise RuntimeError(f"Release failed on {len(failed)} of {len(dbs)} target(s): "
+                    f"{', '.join(failed)}")
 
         pass
         
-    def clone_production(self, force):
+    def clone_production(self, force, wait=True):
         """Clones production database into new db named after branch name."""
-        sf.clone_production(self.sf_safe_branch, force)
+        sf.clone_production(self.sf_safe_branch, force, wait=wait)
+
+    def print_async_status(self, wait=False):
+        """Prints clone and drop operations submitted without waiting and
+           collects the finished ones (all of them with wait=True)."""
+        dbs = AsyncQuery.pending()
+        if not dbs:
+            logger.info("No pending clone or drop operations.")
+            return
+        states, failed = {}, []
+        for db in dbs:
+            try:
+                state = sf.async_status(db)
+                if state:
+                    states[db] = state
+            except RuntimeError as e:
+                # e.g. query ID no longer known, status --wait collects it
+                logger.error(f"Can't read status of operation on {db}: {e}")
+                failed.append(db)
+        logger.info("|{:_^32}|{:_^11}|{:_^26}|".format('database', 'operation', 'status'))
+        for db in dbs:
+            operation, query_id, status, running = states.get(db, ('?', None, 'UNKNOWN', False))
+            logger.info("| {:<30.30} | {:^9} | {:^24} |".format(db, operation, status.lower()))
+
+        if wait:
+            # collected (and forgotten) even if status can't be read
+            for db in failed:
+                try:
+                    sf.wait_async(db)
+                except RuntimeError as e:
+                    logger.error(e)
+        for db, (operation, query_id, status, running) in states.items():
+            if running and not wait:
+                continue
+            try:
+                sf.wait_async(db)
+                logger.info(f"{operation} of {db} finished.")
+            except RuntimeError as e:
+                logger.error(e)
+                failed.append(db)
+        if failed:
+            raise RuntimeError(f"Operation failed on: {', '.join(failed)}")
 
     def compare_sf_git(self, branch=None):
         """Compares Snowflake and current branch DDLs."""
@@ -117,10 +198,102 @@ class Model():
         ddls = {}
         for f in Path(self.MODEL_DIR).rglob('*'):
             if self.EXTENSIONS.search(str(f)):
-                o_name, o_type, easy_ddl, sql = sql_meta(str(f))
+                o_name, o_type, easy_ddl, sql = self._cached_sql_meta(f)
                 ddls[(o_type + '#' + o_name).upper()] = (o_name, o_type, str(f))
         return ddls
 
+    def validate(self, shard=None) -> None:
+        """Validates model files (of shard (i, n) only if given), writes
+           JSON results to VALIDATE_DIR for validate --merge."""
+        i, n = shard or (1, 1)
+        files = self.get_shard(sorted(str(f) for f in Path(self.MODEL_DIR).rglob('*')
+                                      if self.EXTENSIONS.search(str(f))), i, n)
+        logger.info(f"Validating shard {i}/{n}: {len(files)} file(s).")
+
+        results = []
+        for f in files:
+            try:
+                o_name, o_type, easy_ddl, sql = self._cached_sql_meta(Path(f))
+                results.append({'file': f, 'key': (o_type + '#' + o_name).upper()})
+            except AssertionError as e:
+                results.append({'file': f, 'error': str(e)})
+
+        os.makedirs(self.VALIDATE_DIR, exist_ok=True)
+        filename = os.path.join(self.VALIDATE_DIR, f"shard-{i}-of-{n}.json")
+        with open(filename, 'w') as shard_file:
+            json.dump({'shard': i, 'shards': n, 'results': results}, shard_file, indent=1)
+        logger.info(f"Results written to {filename}.")
+
+        self._report_validation(results, check_duplicates=(n == 1))
+
+    @staticmethod
+    def get_shard(files, i, n) -> list:
+        """Deterministically partitions files into n shards of similar total
+           size (biggest files first, each to the lightest shard, ties broken
+           by path hash) and returns shard i (1-based)."""
+        assert 1 <= i <= n, f"Invalid shard {i}/{n}."
+        path_hash = lambda f: hashlib.md5(f.encode()).hexdigest()
+        loads = [0] * n
+        shard = []
+        for f in sorted(files, key=lambda f: (-os.path.getsize(f), path_hash(f))):
+            lightest = loads.index(min(loads))
+            loads[lightest] += os.path.getsize(f) or 1
+            if lightest == i - 1:
+                shard.append(f)
+        return sorted(shard)
+
+    def merge_validation(self) -> None:
+        """Combines shard results from VALIDATE_DIR into one report and checks
+           for objects defined in more than one file."""
+        shards = {}
+        for filename in sorted(Path(self.VALIDATE_DIR).glob('shard-*.json')):
+            with open(filename, 'r') as shard_file:
+                shard = json.load(shard_file)
+            shards.setdefault(shard['shards'], {})[shard['shard']] = shard['results']
+        assert shards, f"No shard results found in {self.VALIDATE_DIR}."
+        assert len(shards) == 1, (f"Results of different shard counts ({', '.join(map(str, shards))}) "
+                f"found in {self.VALIDATE_DIR}.")
+        n, results = shards.popitem()
+        missing = [str(i) for i in range(1, n + 1) if i not in results]
+        assert not missing, f"Results of shard(s) {', '.join(missing)} of {n} missing."
+
+        logger.info(f"Merging results of {n} shard(s).")
+        self._report_validation([r for i in sorted(results) for r in results[i]])
+
+    @staticmethod
+    def _report_validation(results, check_duplicates=True) -> None:
+        """Logs invalid files and duplicate TYPE#NAME definitions, raises
+           if any was found."""
+        errors = [r for r in results if 'error' in r]
+        for r in errors:
+            logger.error(f"{r['file']}: {r['error']}")
+
+        definitions = {}
+        for r in results:
+            if 'key' in r:
+                definitions.setdefault(r['key'], []).append(r['file'])
+        duplicates = {key: files for key, files in definitions.items() if len(files) > 1}
+        if check_duplicates:
+            for key, files in sorted(duplicates.items()):
+                logger.error(f"{key} defined in {len(files)} files: {', '.join(files)}")
+        else:
+            duplicates = {}
+
+        logger.info(f"{len(results)} file(s) validated: {len(errors)} invalid, "
+                f"{len(duplicates)} duplicate definition(s).")
+        if errors or duplicates:
+            raise RuntimeError("Model validation failed.")
+
+    def _cached_sql_meta(self, f):
+        """sql_meta() memoized on file size and mtime (pays off in daemon mode).
+           One entry per file, a changed file replaces its entry."""
+        stat = f.stat()
+        path, version = str(f.resolve()), (stat.st_mtime_ns, stat.st_size)
+        cached = self._ddl_cache.get(path)
+        if cached is None or cached[0] != version:
+            cached = self._ddl_cache[path] = (version, sql_meta(str(f)))
+        return cached[1]
+
     @staticmethod
     def _change_into_release_entry(change, commit_hash):
         """Converts a git.change of a file into a release candidate entry (string)."""
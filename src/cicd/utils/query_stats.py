@@ -0,0 +1,131 @@
+import os
+import json
+import threading
+from time import time
+
+from .log import logger
+from .config import config
+from .metrics import metrics
+from .utils import remove_file
+
+
+class QueryStats():
+    """Query IDs of release statements (tagged with QUERY_TAG) and their
+       server-side execution stats from QUERY_HISTORY: queue, compile and
+       execution time, bytes scanned and warehouse. Query IDs are kept in a
+       local file until stats are harvested (at the end of the run or by
+       `stats` action), the last harvest is kept for `stats` action too."""
+
+    STATS_DIR = '.stats'
+    PENDING   = os.path.join(STATS_DIR, 'pending.jsonl')
+    LAST      = os.path.join(STATS_DIR, 'last.json')
+    ENABLED   = config.read_config('query_stats', default='true').lower() in ('true', 'yes', '1')
+    RETENTION = 7 * 24 * 3600    # INFORMATION_SCHEMA.QUERY_HISTORY window
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def tag(release_hash, label, i, chunk=None) -> str:
+        """Returns QUERY_TAG identifying release, file and statement."""
+        tag = {'cicd': release_hash[:12], 'file': label, 'statement': i + 1}
+        if chunk is not None:
+            tag['chunk'] = chunk + 1
+        return json.dumps(tag)
+
+    @staticmethod
+    def set_tag_sql(tag) -> str:
+        """Returns ALTER SESSION statement setting QUERY_TAG to tag."""
+        return config.sql('set_query_tag').format(tag=tag.replace("'", "''"))
+
+    def record(self, db, query_id, tag) -> None:
+        """Remembers query ID of release statement run in db. It's written
+           right away, so stats of a failed run can be harvested too."""
+        if not self.ENABLED or not query_id:
+            return
+        with self._lock:
+            os.makedirs(self.STATS_DIR, exist_ok=True)
+            with open(self.PENDING, 'a') as pending:
+                pending.write(json.dumps({'db': db, 'query_id': query_id, 'tag': tag,
+                                          'run_on': time()}) + '\n')
+
+    def pending(self) -> list:
+        if not os.path.exists(self.PENDING):
+            return []
+        with open(self.PENDING, 'r') as pending:
+            return [json.loads(line) for line in pending if line.strip()]
+
+    def harvest(self, fetch) -> list:
+        """Reads stats of pending queries, `fetch(db, query_ids, since)`
+           returns QUERY_HISTORY rows (see query_history query) in one bulk
+           query per database. Queries not in history yet (or of a database
+           that failed) stay pending until they fall out of the history
+           window."""
+        pending = self.pending()
+        by_db = {}
+        for query in pending:
+            by_db.setdefault(query['db'], []).append(query)
+        rows = {}
+        for db, queries in by_db.items():
+            since = min(query['run_on'] for query in queries)
+            try:
+                for row in fetch(db, [query['query_id'] for query in queries], since):
+                    rows[row[0]] = row
+            except RuntimeError as e:
+                logger.warning(f"Can't read QUERY_HISTORY of {len(queries)} query(ies) run in {db}: {e}")
+
+        stats, missing, expired = [], [], 0
+        for query in pending:
+            row = rows.get(query['query_id'])
+            if row is None:
+                if query['run_on'] < time() - self.RETENTION:
+                    expired += 1
+                else:
+                    missing.append(query)
+                continue
+            query_id, warehouse, queued, compile_ms, execution, scanned, elapsed = row
+            stats.append({'db': query['db'], 'query_id': query_id, 'tag': json.loads(query['tag']),
+                          'warehouse': warehouse, 'queued_ms': queued, 'compile_ms': compile_ms,
+                          'execution_ms': execution, 'bytes_scanned': scanned,
+                          'elapsed_ms': elapsed})
+            metrics.observe('server_queued_seconds', queued / 1000)
+            metrics.observe('server_compile_seconds', compile_ms / 1000)
+            metrics.observe('server_execution_seconds', execution / 1000)
+            metrics.inc('server_bytes_scanned', scanned)
+
+        with self._lock:
+            with open(self.PENDING, 'w') as pending_file:
+                pending_file.writelines(json.dumps(query) + '\n' for query in missing)
+            if not missing:
+                remove_file(self.PENDING)
+        if expired:
+            logger.warning(f"{expired} query(ies) older than QUERY_HISTORY retention dropped.")
+        if missing:
+            logger.info(f"{len(missing)} query(ies) not in QUERY_HISTORY yet, run 'stats' later.")
+        if stats:
+            with open(self.LAST, 'w') as last:
+                json.dump(stats, last, indent=1)
+        return stats
+
+    def last(self) -> list:
+        """Returns stats of the last harvest."""
+        if not os.path.exists(self.LAST):
+            return []
+        with open(self.LAST, 'r') as last:
+            return json.load(last)
+
+    @staticmethod
+    def print(stats) -> None:
+        """Prints stats table, slowest statements first."""
+        logger.info("|{:_^40}|{:_^6}|{:_^16}|{:_^11}|{:_^11}|{:_^11}|{:_^12}|".format(
+                'file', '#', 'warehouse', 'queued', 'compile', 'execution', 'scanned'))
+        for row in sorted(stats, key=lambda row: -row['elapsed_ms']):
+            statement = str(row['tag']['statement'])
+            if 'chunk' in row['tag']:
+                statement += f".{row['tag']['chunk']}"
+            logger.info("| {:<38.38} | {:>4} | {:<14.14} | {:>7.1f} s | {:>7.1f} s | {:>7.1f} s | {:>7.1f} MB |".format(
+                    row['tag']['file'] or row['db'], statement, row['warehouse'] or '',
+                    row['queued_ms'] / 1000, row['compile_ms'] / 1000, row['execution_ms'] / 1000,
+                    row['bytes_scanned'] / 1024 / 1024))
+
+query_stats = QueryStats()
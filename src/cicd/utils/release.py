@@ -1,13 +1,24 @@
 import os
 import re
+import json
 from datetime import datetime
+from collections import namedtuple
+from pathlib import Path
 
 from .config import config
 from .log import logger, is_debug
-from .utils import get_file_contents, hexDigest, remove_file
+from .utils import get_file_contents, hexDigest, remove_file, yes_or_no
 from .dwhrepo import repo
 from .snowflake import sf
-from .sql import sql_meta, print_sql
+from .lease import Lease
+from .rollback import RollbackPoint
+from .metrics import metrics
+from .query_stats import query_stats
+from .sql import sql_meta, print_sql, split_sql, split_sql_hints, parse_sql, log_statement_hints, content_hash, \
+        ddl_fingerprints, sql_string, suffixed_name, STATEMENT_HINT, TYPE_DIR
+
+# model file change found by comparing content hashes (quacks like git.Diff)
+ObjectChange = namedtuple('ObjectChange', 'change_type a_path b_path')
 
 class Release():
     """Performs releases and handles release files."""
@@ -15,12 +26,21 @@ class Release():
     MODEL_DIR          = config.read_config('model_dir', default='model')
     RELEASE_CANDIDATE  = os.path.join(RELEASES_DIR, 'release_candidate.sql')
     RELEASE_SHA        = os.path.join(RELEASES_DIR, 'release_candidate.sha')
+    MANIFEST           = os.path.join(RELEASES_DIR, 'MANIFEST')
     RELEASE_TABLE      = 'PUBLIC.DWH_RELEASES_HISTORY'
+    OBJECT_HASH_TABLE  = config.read_config('object_hash_table', default='')
+    HASH_CACHE         = os.path.join('.hashes', 'blobs.json')
     INCLUDED           = re.compile(r'-- \[(?P<change>.)\] (?P<inc>(NOT_)?INCLUDED):(?P<file>{}/\S+)( #)?(?P<hash>\S+)?'.format(MODEL_DIR))
     HERE_STMT          = '<<HERE>>'
+    BUNDLE_FORMAT      = 1
+    DEFAULT_BUNDLE     = 'release.bundle.json'
+    BUNDLE_HINTS       = ('warehouse', 'chunk')
+    COALESCE_TYPES     = {'VIEW', 'FUNCTION', 'PROCEDURE', 'FILE FORMAT'}
 
-    def __init__(self):
-        self.sf_safe_branch  = repo.get_sf_safe_branch()
+    @property
+    def sf_safe_branch(self):
+        """Active branch (read on every use, as daemon outlives checkouts)."""
+        return repo.get_sf_safe_branch()
 
     def check_release_candidate(self):
         """Asserts if release candidate file existis and was not modified."""
@@ -45,26 +65,56 @@ class Release():
         with open(self.RELEASE_CANDIDATE, 'r') as release_candidate_file:
             return release_candidate_file.readlines()
     
-    def check_release_dir_clean(self, base_commit) -> None:
+    def check_release_dir_clean(self, base_commit, branch=None) -> None:
         """Checks if all the release files were applied in current DB."""
-        files_added = self.get_unsynced_releases(base_commit)
+        files_added = self.get_unsynced_releases(base_commit, branch)
 
         if len(files_added) > 0:
             raise RuntimeError("Files present in {} folder that were not applied on the "
                     "database.\nYou have to 'sync' first.".format(self.RELEASES_DIR))
 
-    def sync(self, branch=None, dry_run=False) -> None:
+    def sync(self, branch=None, dry_run=False, targets=False, resume=False, queue=False,
+             skip_unchanged=False, coalesce=False) -> None:
         """Syncs non-applied changes in releases and model folders."""
+        if skip_unchanged and (targets or resume):
+            # resumed release has to consist of the very same statements
+            logger.warning("--skip-unchanged is not supported with --targets and --resume, ignoring it.")
+            skip_unchanged = False
+        if coalesce and targets:
+            # targets share resolved release files, but each has its own pending ones
+            logger.warning("--coalesce is not supported with --targets, ignoring it.")
+            coalesce = False
+        if targets and queue:
+            raise RuntimeError("--queue is not supported with --targets, each target would need "
+                    "its own deploy lease.")
+        if targets:
+            self.sync_targets(dry_run=dry_run, resume=resume)
+            return
         if branch is None:
             branch = self.sf_safe_branch
 
+        if queue and not dry_run:
+            # only one deployer at a time, it applies everything pending
+            # (also releases merged after this run was triggered)
+            with sf.kept_sessions(), Lease(branch) as lease:
+                self._sync(branch, dry_run, resume, lease, skip_unchanged, coalesce)
+            return
+        self._sync(branch, dry_run, resume, skip_unchanged=skip_unchanged, coalesce=coalesce)
+
+    def _sync(self, branch, dry_run, resume, lease=None, skip_unchanged=False,
+              coalesce=False) -> None:
         commit_hash = self.get_base_commit(branch)
-        files = self.get_unsynced_releases(commit_hash)
+        files = self.get_unsynced_releases(commit_hash, branch)
+        superseded = self.superseded_includes([change.b_path for change in files.values()
+                                               if change.change_type != 'D']) if coalesce else {}
 
         if files.values():
             logger.warning("Syncing changes:")
         else:
             logger.info("No pending changes to sync.")
+        # read once, then refreshed with objects touched by each release file
+        server_ddls = sf.get_ddl_fingerprints(branch) if skip_unchanged and files else None
+        applied = []
         for change in files.values():
             if change.change_type == 'D':
                 logger.warning(f"Skipping removed release file {change.a_path}.")
@@ -73,19 +123,83 @@ class Release():
             changed_file = change.b_path
             logger.info("Running release file {}:".format(changed_file))
 
-            deploy_sql = self.release_file_to_sql(get_file_contents(changed_file))
+            deploy_sql = self.release_file_to_sql(get_file_contents(changed_file), server_ddls,
+                                                  superseded.get(changed_file), applied)
 
             if is_debug():
                 print_sql(deploy_sql)
             if dry_run:
                 if not is_debug():
                     print_sql(deploy_sql)
+                log_statement_hints(*split_sql_hints(deploy_sql), config.read_config('warehouse'))
                 logger.info("Skipping SQL execution due to --dry-run.")
                 return
 
-            sf.perform_release(deploy_sql, branch)
+            sf.perform_release(deploy_sql, branch, resume=resume, label=changed_file)
+            if server_ddls is not None:
+                sf.refresh_ddl_fingerprints(server_ddls, deploy_sql, branch)
+                applied.append(deploy_sql)
             self.insert_release_entry(changed_file, branch)
+            metrics.inc('releases_applied')
+            self.save_object_hashes(self.object_hash_changes(get_file_contents(changed_file)), branch,
+                                    base_commit=commit_hash)
+            if lease:
+                lease.renew()
     
+    def sync_targets(self, dry_run=False, resume=False) -> None:
+        """Syncs all the deploy targets concurrently. Release files are
+           resolved once, each target applies its own pending files."""
+        dbs = sf.get_targets()
+        base_commits = {}
+        def get_base_commit(db):
+            base_commits[db] = self.get_base_commit(None, db=db)
+        failed = sf.fan_out(dbs, get_base_commit)
+        if failed and sf.failure_policy() == 'abort':
+            raise RuntimeError(f"Can't read release history from: {', '.join(failed)}")
+
+        # git is only touched here, in the main thread
+        pending, resolved, commits, hashes = {}, {}, {}, {}
+        for db in dbs:
+            if db in failed:
+                continue
+            changes = self.get_unsynced_releases(base_commits[db], None, db=db).values()
+            pending[db] = [change.b_path for change in changes if change.change_type != 'D']
+            for changed_file in pending[db]:
+                if changed_file not in resolved:
+                    release_sql = get_file_contents(changed_file)
+                    resolved[changed_file] = self.release_file_to_sql(release_sql)
+                    commits[changed_file] = repo.get_file_last_commit_hash(changed_file)
+                    hashes[changed_file] = self.object_hash_changes(release_sql)
+            logger.info(f"{db}: {len(pending[db])} pending release file(s)")
+
+        if dry_run:
+            for changed_file, deploy_sql in resolved.items():
+                logger.info(f"Release file {changed_file}:")
+                print_sql(deploy_sql)
+                log_statement_hints(*split_sql_hints(deploy_sql), config.read_config('warehouse'))
+            logger.info("Skipping SQL execution due to --dry-run.")
+            return
+
+        seeds = {}
+        if self.OBJECT_HASH_TABLE:
+            for db in pending:
+                if pending[db] and base_commits[db] not in seeds:
+                    seeds[base_commits[db]] = self.seed_object_hashes(base_commits[db])
+        def apply(db):
+            for changed_file in pending[db]:
+                logger.info(f"{db}: running release file {changed_file}")
+                sf.perform_release(resolved[changed_file], None, db=db, resume=resume,
+                                   label=changed_file)
+                self.insert_release_entry(changed_file, None, db=db, commit=commits[changed_file])
+                metrics.inc('releases_applied', db=db)
+                self.save_object_hashes(hashes[changed_file], None, db=db,
+                                        seed=seeds.get(base_commits[db]))
+        failed.update(sf.fan_out(list(pending), apply))
+
+        if failed:
+            raise RuntimeError(f"Sync failed on {len(failed)} of {len(dbs)} target(s): "
+                    f"{', '.join(failed)}")
+
     def test_sync(self):
         last_commit_sha = repo.get_last_commit_sha()
         sf.clone_production(branch=last_commit_sha, force=True)
@@ -96,18 +210,32 @@ class Release():
         finally:
             sf.drop_clone(branch=last_commit_sha)
 
-    def save_release(self, sql):
+    def save_release(self, sql, dbs=None):
         """Save release file (if needed) commits it and adds new entry in
-           DWH changelog table."""
+           DWH changelog table (in each of dbs if given)."""
 
         release_filename = self._gen_release_filename()
         logger.info(f'Writing to {release_filename}.')
         with open(release_filename, 'a+') as release_file:
             release_file.write(sql)
 
-        repo.commit_release(release_filename)
-
-        self.insert_release_entry(release_filename, self.sf_safe_branch)
+        if self.manifest_exists():
+            self.update_manifest(release_filename)
+            repo.commit_release(release_filename, self.MANIFEST)
+        else:
+            repo.commit_release(release_filename)
+
+        hashes = self.object_hash_changes(sql)
+        if dbs:
+            commit = repo.get_file_last_commit_hash(release_filename)
+            for db in dbs:
+                base_commit = self.get_base_commit(None, db=db) if hashes is not None else None
+                self.insert_release_entry(release_filename, None, db=db, commit=commit)
+                self.save_object_hashes(hashes, None, db=db, base_commit=base_commit)
+        else:
+            base_commit = self.get_base_commit(self.sf_safe_branch) if hashes is not None else None
+            self.insert_release_entry(release_filename, self.sf_safe_branch)
+            self.save_object_hashes(hashes, self.sf_safe_branch, base_commit=base_commit)
         self.remove_release_candidate()
 
     def remove_release_candidate(self):
@@ -135,6 +263,21 @@ class Release():
         
         logger.info(f"{self.RELEASE_CANDIDATE} and {self.RELEASE_SHA} created.")
 
+    def harvest_query_stats(self) -> list:
+        """Reads server-side stats of release statements not harvested yet
+           (one QUERY_HISTORY query per database)."""
+        return query_stats.harvest(sf.query_history)
+
+    def print_query_stats(self) -> None:
+        """Prints server-side stats of the last release statements."""
+        if query_stats.pending():
+            self.harvest_query_stats()
+        stats = query_stats.last()
+        if not stats:
+            logger.info("No statement stats recorded yet.")
+            return
+        query_stats.print(stats)
+
     def print_release_history(self):
         """Returns release history."""
         release_history = self.release_history(self.sf_safe_branch)
@@ -145,29 +288,29 @@ class Release():
                 rel[0], str(rel[1])[-30:], rel[2], rel[3], '•' if rel[4] else '', '•' if rel[5] else ''))
 
     def release_history(self, branch):
-        """Returns release history from DB."""
+        """Yields release history from DB."""
         sql = config.sql('release_history').format(
             RELEASE_TABLE=self.RELEASE_TABLE, SF_PROD_NAME=sf.SF_PROD_NAME)
-        history = sf.run_single_statament(sql, branch)
-        return history
+        return sf.iter_rows(sql, branch)
 
-    def get_base_commit(self, branch):
+    def get_base_commit(self, branch, db=None):
         """Queries the based commit in release history table."""
         
         sql = config.sql('get_base_commit').format(RELEASE_TABLE=self.RELEASE_TABLE)
-        commit = sf.run_single_statament(sql, branch)
+        commit = sf.run_single_statament(sql, branch, db=db)
         assert len(commit) > 0, "No data in release history table, you need to create an initial entry"
         logger.debug("Base commit hash in current database is {}."
                 .format(commit[0][0]))
         return commit[0][0]
 
-    def insert_release_entry(self, filename, branch):
+    def insert_release_entry(self, filename, branch, db=None, commit=None):
         """Inserts a row in a release history table."""
-        commit = repo.get_file_last_commit_hash(filename)
+        if commit is None:
+            commit = repo.get_file_last_commit_hash(filename)
 
         sql = config.sql('insert_release_entry').format(
             RELEASE_TABLE=self.RELEASE_TABLE, commit=commit, filename=filename)
-        sf.run_single_statament(sql, branch)
+        sf.run_single_statament(sql, branch, db=db)
         logger.info("New entry in release history table with {}"
                 .format(commit))
 
@@ -194,7 +337,7 @@ class Release():
             branch, user, datetime.now())
 
         for line in release.get_release_candidate_lines():
-            if line.startswith('--.'):
+            if line.startswith('--.') and not STATEMENT_HINT.match(line):
                 continue
         
             included = self.INCLUDED.search(line)    
@@ -207,37 +350,564 @@ class Release():
         
         return release_sql
 
-    def release_file_to_sql(self, release_sql) -> str:
-        """Converts release file (with filenames) to SQL."""
+    def release_file_to_sql(self, release_sql, server_ddls=None, superseded=None, applied=()) -> str:
+        """Converts release file (with filenames) to SQL. With server_ddls
+           ({TYPE#SCHEMA.NAME: fingerprint}) INCLUDEs with definitions
+           identical to the server ones are skipped unless an earlier
+           statement of the release (or of applied SQL run since
+           fingerprints were read) mentions the object or anything it
+           references. INCLUDEs in superseded lines (see
+           superseded_includes) are skipped too."""
         sql = ""
-        for line in release_sql.splitlines():
+        # statements run before the current line, fingerprints predate them
+        earlier = list(applied)
+        for line_no, line in enumerate(release_sql.splitlines()):
             included = self.INCLUDED.search(line)
             logger.debug(line)
             if included:
                 sql += line + "\n"
-                if included.group('inc') == 'INCLUDED':
-                    sql += repo.get_file_contents_by_commit(included.group('file'), included.group('hash'))
-
-            if not line.startswith('--'):
+                if superseded and line_no in superseded:
+                    logger.info(f"Skipping {included.group('file')}, superseded by a later release file.")
+                    sql += "-- skipped, superseded by a later release file\n"
+                    metrics.inc('includes_coalesced')
+                elif included.group('inc') == 'INCLUDED':
+                    contents = repo.get_file_contents_by_commit(included.group('file'), included.group('hash'))
+                    if server_ddls is not None and self._definition_unchanged(contents, server_ddls) \
+                            and not self._mentioned_before(contents, earlier):
+                        logger.info(f"Skipping {included.group('file')}, definition on the server is identical.")
+                        sql += "-- skipped, definition on the server is identical\n"
+                        metrics.inc('includes_skipped')
+                    else:
+                        sql += contents
+                        earlier.append(contents)
+
+            if not line.startswith('--') or STATEMENT_HINT.match(line):
                 sql += line + "\n"
+                if not line.startswith('--'):
+                    earlier.append(line)
 
+        metrics.inc('sql_resolved_bytes', len(sql.encode()))
         return sql
     
-    def get_unsynced_releases(self, base_commit):
-        """Returns list with unsynced releases."""
+    def superseded_includes(self, release_files) -> dict:
+        """Finds INCLUDEs of views, functions, procedures and file formats
+           replaced by a later INCLUDE of the same model file creating the
+           same object in the pending release files (in order). An INCLUDE
+           is superseded only if nothing in between mentions the object.
+           Returns {release file: {line numbers}}."""
+        # (release file, line number, model file, object name, SQL) in apply order
+        events = []
+        for release_file in release_files:
+            for line_no, line in enumerate(get_file_contents(release_file).splitlines()):
+                included = self.INCLUDED.search(line)
+                if included and included.group('inc') == 'INCLUDED':
+                    contents = repo.get_file_contents_by_commit(included.group('file'), included.group('hash'))
+                    events.append((release_file, line_no, included.group('file'),
+                                   self._coalescable_name(included.group('file'), contents), contents))
+                elif not line.startswith('--'):
+                    events.append((release_file, line_no, None, None, line))
+
+        # a renamed object (same model file, other name) supersedes nothing
+        last = {(event[2], event[3]): i for i, event in enumerate(events) if event[3]}
+        superseded = {}
+        for i, (release_file, line_no, model_file, name, sql) in enumerate(events):
+            if not name or last[(model_file, name)] == i:
+                continue
+            # raw text: names in strings and $$ bodies (EXECUTE IMMEDIATE,
+            # procedure code) count, a false mention only runs one more INCLUDE
+            mention = re.compile(r'(?<![\w$])' + re.escape(name) + r'(?![\w$])', re.I)
+            if not any(mention.search(other[4]) for other in events[i + 1:last[(model_file, name)]]
+                       if (other[2], other[3]) != (model_file, name)):
+                superseded.setdefault(release_file, set()).add(line_no)
+        if superseded:
+            logger.info(f"Coalescing: {sum(map(len, superseded.values()))} INCLUDE(s) superseded "
+                    "by later release files will be skipped.")
+        return superseded
+
+    def _coalescable_name(self, model_file, contents):
+        """Returns bare name of easy-DDL object created by model file (or None)."""
+        dir_type = TYPE_DIR.search(model_file)
+        if not dir_type or re.sub(r'[\W_]', ' ', dir_type.group('dir_type')).upper() not in self.COALESCE_TYPES:
+            return None
+        creates = [meta for meta in parse_sql(contents) if meta.verb == 'CREATE' and meta.o_name]
+        if not creates:
+            return None
+        return creates[0].o_name.split('.')[-1].strip('"')
+
+    @staticmethod
+    def _mentioned_before(contents, earlier) -> bool:
+        """Checks if any of earlier SQL mentions objects contents creates or
+           references (e.g. DROP or ALTER of a view, ALTER of a table under
+           SELECT * view). Raw text like superseded_includes."""
+        names = set()
+        for meta in parse_sql(contents):
+            names.update(name.split('.')[-1].strip('"') for name in [meta.o_name, *meta.references] if name)
+        mentions = [re.compile(r'(?<![\w$])' + re.escape(name) + r'(?![\w$])', re.I) for name in names]
+        return any(mention.search(sql) for sql in earlier for mention in mentions)
+
+    @staticmethod
+    def _definition_unchanged(contents, server_ddls) -> bool:
+        """Checks if file contains only CREATE statements all matching server."""
+        fingerprints = ddl_fingerprints(contents, strict=True)
+        return bool(fingerprints) and all(server_ddls.get(key) == fingerprint
+                                          for key, fingerprint in fingerprints.items())
+
+    def build_bundle(self, output, filename=None) -> None:
+        """Resolves release file (or all unsynced release files) into a
+           self-contained bundle: statements split and with INCLUDEs inlined,
+           commit hashes, checksums and release history rows."""
+        if filename:
+            files = [filename]
+        else:
+            base_commit = self.get_base_commit(self.sf_safe_branch)
+            files = [change.b_path for change in
+                     self.get_unsynced_releases(base_commit, self.sf_safe_branch).values()
+                     if change.change_type != 'D']
+
+        releases = []
+        for release_file in files:
+            logger.info(f"Compiling release file {release_file}")
+            release_sql = get_file_contents(release_file)
+            self._assert_committed(release_file, release_sql)
+            commit = repo.get_file_last_commit_hash(release_file)
+            statements, hints = split_sql_hints(self.release_file_to_sql(release_sql))
+            releases.append({
+                'file': release_file,
+                'commit': commit,
+                'includes': [{'file': included.group('file'), 'commit': included.group('hash')}
+                             for included in self.INCLUDED.finditer(release_sql)
+                             if included.group('inc') == 'INCLUDED'],
+                'statements': [{'sql': statement, 'checksum': hexDigest(statement),
+                                'warehouse': hints.get(i, {}).get('warehouse'),
+                                'chunk': hints.get(i, {}).get('chunk')}
+                               for i, statement in enumerate(statements)],
+                'history': {'commit': commit, 'filename': release_file},
+                'object_hashes': self.object_hash_changes(release_sql)})
+
+        bundle = {'format': self.BUNDLE_FORMAT, 'branch': repo.get_branch(),
+                  'built_from': repo.get_last_commit_sha(), 'releases': releases,
+                  'checksum': hexDigest(json.dumps(releases, sort_keys=True))}
+        with open(output, 'w') as bundle_file:
+            json.dump(bundle, bundle_file, indent=1)
+        logger.info(f"Bundle with {len(releases)} release file(s) written to {output}.")
+
+    def _assert_committed(self, release_file, release_sql) -> None:
+        """Checks that release file is committed and each of its INCLUDEs
+           has a commit hash, a bundle records their commits (the release
+           candidate is committed by deploy, it can't be built)."""
+        missing = [included.group('file') for included in self.INCLUDED.finditer(release_sql)
+                   if included.group('inc') == 'INCLUDED' and not included.group('hash')]
+        assert not repo.get_uncommitted_files([release_file]), (f"Can't build {release_file}, "
+                "it is not committed. Commit it as a release file first.")
+        assert not missing, (f"Can't build {release_file}, INCLUDEs without commit hash "
+                f"(not committed model files): {', '.join(missing)}.")
+
+    def load_bundle(self, path) -> dict:
+        """Reads bundle file and verifies its checksums."""
+        with open(path, 'r') as bundle_file:
+            bundle = json.load(bundle_file)
+        assert bundle.get('format') == self.BUNDLE_FORMAT, (f"{path} is not a release "
+                f"bundle (format {self.BUNDLE_FORMAT})")
+        assert bundle['checksum'] == hexDigest(json.dumps(bundle['releases'], sort_keys=True)), (
+                f"{path} checksum mismatch, bundle was modified or is corrupted.")
+        for rel in bundle['releases']:
+            for i, statement in enumerate(rel['statements']):
+                assert statement['checksum'] == hexDigest(statement['sql']), (
+                        f"Checksum mismatch of statement #{i + 1} of {rel['file']} in {path}.")
+        return bundle
+
+    def deploy_bundle(self, path, dry_run=False, resume=False) -> None:
+        """Deploys precompiled bundle. Neither git history nor SQL parsing
+           is needed, releases already present in history are skipped."""
+        bundle = self.load_bundle(path)
+        branch = self.sf_safe_branch
+        if bundle['branch'] != repo.get_branch():
+            logger.warning(f"Bundle was built on branch {bundle['branch']}, "
+                    f"deploying from {repo.get_branch()}.")
+
+        for rel in bundle['releases']:
+            history = rel['history']
+            if self.release_applied(history['filename'], history['commit'], branch):
+                logger.info(f"Skipping {rel['file']}, already applied.")
+                continue
+
+            logger.info(f"Running release file {rel['file']} from bundle:")
+            statements = [statement['sql'] for statement in rel['statements']]
+            hints = {i: {name: statement[name] for name in self.BUNDLE_HINTS if statement.get(name)}
+                     for i, statement in enumerate(rel['statements'])
+                     if any(statement.get(name) for name in self.BUNDLE_HINTS)}
+            if is_debug() or dry_run:
+                for statement in statements:
+                    print_sql(statement)
+            if dry_run:
+                log_statement_hints(statements, hints, config.read_config('warehouse'))
+                logger.info("Skipping SQL execution due to --dry-run.")
+                continue
+
+            sf.perform_statements(statements, branch, resume=resume, hints=hints, label=rel['file'])
+            self.insert_release_entry(history['filename'], branch, commit=history['commit'])
+            if rel.get('object_hashes'):
+                # no git at deploy time, an empty hash table can't be seeded
+                self.save_object_hashes(rel['object_hashes'], branch, seed={})
+
+    def deployed_object_hashes(self, branch, db=None) -> dict:
+        """Returns {model file: (content hash, commit)} of deployed objects."""
+        sql = config.sql('object_hashes').format(OBJECT_HASH_TABLE=self.OBJECT_HASH_TABLE)
+        return {row[0]: (row[1], row[2]) for row in sf.iter_rows(sql, branch, db)}
+
+    def model_file_hashes(self, commit='HEAD') -> dict:
+        """Returns {model file: content hash} of model files in commit. Hashes
+           are cached by git blob SHA, only files with new contents are read
+           and formatted."""
+        blobs = repo.get_tracked_files(self.MODEL_DIR, commit=commit)
+        cache = {}
+        if os.path.exists(self.HASH_CACHE):
+            with open(self.HASH_CACHE, 'r') as cache_file:
+                cache = json.load(cache_file)
+        hashes, missing = {}, 0
+        for f, blob in blobs.items():
+            if blob not in cache:
+                cache[blob] = content_hash(repo.get_blob_contents(blob))
+                missing += 1
+            hashes[f] = cache[blob]
+        if missing:
+            logger.debug(f"Content hashes of {missing} model file(s) computed.")
+        if missing and commit == 'HEAD':
+            os.makedirs(os.path.dirname(self.HASH_CACHE), exist_ok=True)
+            with open(self.HASH_CACHE, 'w') as cache_file:
+                # blobs no longer in HEAD are dropped, the cache doesn't grow
+                json.dump({blob: cache[blob] for blob in blobs.values()}, cache_file)
+        return hashes
+
+    def get_changed_objects(self, deployed):
+        """Returns model files (like DWHRepo.get_changed_files) whose content
+           hash differs from the deployed one and {model file: deployed commit}.
+           Removed and added files with the same content are a rename."""
+        current = self.model_file_hashes()
+        removed = {f: deployed[f][0] for f in deployed.keys() - current.keys()}
+        renamed = {h: f for f, h in removed.items()}
+
+        files = {}
+        for f, h in current.items():
+            if f not in deployed:
+                old = renamed.pop(h, None)
+                if old:
+                    del removed[old]
+                files[f] = ObjectChange('R' if old else 'A', old or f, f)
+            elif deployed[f][0] != h:
+                files[f] = ObjectChange('M', f, f)
+        files.update({f: ObjectChange('D', f, f) for f in removed})
+
+        files = dict(sorted(files.items()))
+        for change in files.values():
+            logger.info("  [{}] {}".format(change.change_type, change.b_path))
+        return files, {f: commit for f, (h, commit) in deployed.items()}
+
+    def object_hash_changes(self, release_sql) -> dict:
+        """Returns content hashes of model files applied by release file
+           (NOT_INCLUDED files are assumed to be synced by hand) and files
+           removed by it."""
+        if not self.OBJECT_HASH_TABLE:
+            return None
+        rows, removed = {}, []
+        for included in self.INCLUDED.finditer(release_sql):
+            filename = included.group('file')
+            if included.group('change') == 'D':
+                removed.append(filename)
+                continue
+            commit = included.group('hash') or repo.get_file_last_commit_hash(filename)
+            rows[filename] = [content_hash(repo.get_file_contents_by_commit(filename, commit)), commit]
+        return {'rows': rows, 'removed': removed}
+
+    def seed_object_hashes(self, base_commit) -> dict:
+        """Returns hashes of all model files in base commit of the database
+           (read before the release was applied), used to fill an empty hash
+           table (everything up to base commit is deployed, like in git mode)."""
+        if not base_commit or not repo.has_commit(base_commit):
+            logger.warning(f"Base commit {base_commit} not found in local history.")
+            return {}
+        return {f: [h, base_commit] for f, h in self.model_file_hashes(base_commit).items()}
+
+    def save_object_hashes(self, changes, branch, db=None, seed=None, base_commit=None) -> None:
+        """Stores content hashes of applied model files in OBJECT_HASH_TABLE.
+           An empty table is filled with seed, or hashes of model files in
+           base_commit."""
+        if not self.OBJECT_HASH_TABLE or changes is None:
+            return
+        deployed = self.deployed_object_hashes(branch, db)
+        rows, removed = dict(changes['rows']), list(changes['removed'])
+        if not deployed:
+            seed = self.seed_object_hashes(base_commit) if seed is None else seed
+            if not seed:
+                logger.warning(f"{self.OBJECT_HASH_TABLE} is empty, object hashes not recorded. "
+                        "Deploy or sync from the repository to fill it.")
+                return
+            rows = dict(seed, **rows)
+        # renamed files: drop old name with the same content
+        hashes = {h for h, commit in rows.values()}
+        removed += [f for f, (h, commit) in deployed.items() if h in hashes and f not in rows
+                    and not os.path.exists(f)]
+
+        if rows:
+            values = ', '.join(f"('{sql_string(f)}', '{h}', '{commit}')" for f, (h, commit) in rows.items())
+            sf.run_single_statament(config.sql('merge_object_hashes').format(
+                    OBJECT_HASH_TABLE=self.OBJECT_HASH_TABLE, values=values), branch, db=db)
+        if removed:
+            files = ', '.join(f"'{sql_string(f)}'" for f in removed)
+            sf.run_single_statament(config.sql('delete_object_hashes').format(
+                    OBJECT_HASH_TABLE=self.OBJECT_HASH_TABLE, files=files), branch, db=db)
+        logger.info(f"Object hashes recorded: {len(rows)} updated, {len(removed)} removed.")
+
+    def release_applied(self, filename, commit, branch) -> bool:
+        """Checks if release file at commit is present in release history table."""
+        sql = config.sql('release_applied').format(RELEASE_TABLE=self.RELEASE_TABLE,
+                commit=commit, filename=filename)
+        return sf.run_single_statament(sql, branch)[0][0] > 0
+
+    def get_unsynced_releases(self, base_commit, branch=None, db=None):
+        """Returns list with unsynced releases (from manifest if there is one,
+           otherwise from git diff against base commit)."""
+        if self.manifest_exists():
+            return self.get_pending_releases(base_commit, branch, db)
+        if not repo.has_commit(base_commit):
+            # e.g. queued deployer started before a newer one applied its release
+            raise RuntimeError(f"Base commit {base_commit} of {db or sf.get_db_name(branch)} is not "
+                    "in this checkout, it is behind the database. Pull and run it again.")
         return repo.get_changed_files(index=base_commit,
                 prefix=self.RELEASES_DIR, change_type=('A', 'R', 'M'))
-    
-    def compare_branches_and_clones(self) -> None:
-        branches = repo.get_dev_branches()
-        branches = list(map(lambda x: sf.get_db_name(x), branches))
+
+    def manifest_exists(self) -> bool:
+        return os.path.exists(self.MANIFEST)
+
+    def read_manifest(self) -> dict:
+        """Returns {release file: content hash} in release order."""
+        manifest = {}
+        with open(self.MANIFEST, 'r') as manifest_file:
+            for line in manifest_file:
+                if line.strip():
+                    content_hash, filename = line.rstrip('\n').split('  ', 1)
+                    manifest[filename] = content_hash
+        return manifest
+
+    def write_manifest(self, manifest) -> None:
+        with open(self.MANIFEST, 'w') as manifest_file:
+            manifest_file.writelines(f"{content_hash}  {filename}\n"
+                                     for filename, content_hash in manifest.items())
+
+    def update_manifest(self, release_filename) -> None:
+        """Appends release file to manifest (or updates its hash)."""
+        manifest = self.read_manifest()
+        manifest[release_filename] = hexDigest(get_file_contents(release_filename))
+        self.write_manifest(manifest)
+
+    def _release_files(self) -> set:
+        return {str(f) for f in Path(self.RELEASES_DIR).rglob('*.sql')} - {self.RELEASE_CANDIDATE}
+
+    def build_manifest(self) -> None:
+        """Creates or refreshes manifest: keeps order of listed release files
+           (dropping removed ones, updating changed hashes) and appends the
+           missing ones in order they were added to git."""
+        manifest = self.read_manifest() if self.manifest_exists() else {}
+        present = self._release_files()
+        refreshed = {}
+        for filename, content_hash in manifest.items():
+            if filename not in present:
+                logger.info(f"  [D] {filename}")
+                continue
+            refreshed[filename] = hexDigest(get_file_contents(filename))
+            if refreshed[filename] != content_hash:
+                logger.warning(f"  [M] {filename}")
+
+        order = {f: i for i, f in enumerate(repo.get_files_in_added_order(self.RELEASES_DIR))}
+        for filename in sorted(present - refreshed.keys(), key=lambda f: (order.get(f, len(order)), f)):
+            refreshed[filename] = hexDigest(get_file_contents(filename))
+            logger.info(f"  [A] {filename}")
+
+        self.write_manifest(refreshed)
+        logger.info(f"{self.MANIFEST} written with {len(refreshed)} release file(s), commit it.")
+
+    def get_pending_releases(self, base_commit, branch, db=None) -> dict:
+        """Returns manifest release files not applied in their current version
+           (like DWHRepo.get_changed_files), in manifest order. A file is
+           applied if its contents at the last commit recorded for it in
+           release history are the ones in HEAD. Files with no history entry
+           are compared at base commit instead, so files applied before the
+           manifest was added are not pending. Only trees of those commits
+           are read, the cost does not depend on history length."""
+        manifest = self.read_manifest()
+        unlisted = self._release_files() - manifest.keys()
+        if unlisted:
+            raise RuntimeError(f"Release file(s) missing in {self.MANIFEST}: {', '.join(sorted(unlisted))}.\n"
+                    "Run 'manifest' action to add them.")
+
+        sql = config.sql('applied_release_files').format(RELEASE_TABLE=self.RELEASE_TABLE)
+        applied = {row[0]: row[1] for row in sf.iter_rows(sql, branch, db)}
+        files = {}
+        for filename, content_hash in manifest.items():
+            blob = repo.get_file_blob(filename)
+            if filename in applied:
+                applied_blob = repo.get_file_blob(filename, applied[filename])
+                if applied_blob is None:
+                    # commit not in local history (rewritten), trust the entry
+                    logger.debug(f"Commit {applied[filename]} of {filename} not found, taken as applied.")
+                    continue
+                if applied_blob == blob:
+                    continue
+                change_type = 'M'
+            else:
+                if blob is not None and repo.get_file_blob(filename, base_commit) == blob:
+                    continue
+                change_type = 'A'
+            assert hexDigest(get_file_contents(filename)) == content_hash, (
+                    f"{filename} differs from its {self.MANIFEST} entry. "
+                    "Run 'manifest' action to update it.")
+            files[filename] = ObjectChange(change_type, filename, filename)
+            logger.info("  [{}] {}".format(change_type, filename))
+        return files
+
+    def rollback(self, dry_run=False, force=False) -> None:
+        """Restores objects touched by the last release in branch database to
+           their state from before it: tables with Time Travel, other objects
+           with definitions from model files at the previous base commit."""
+        branch = self.sf_safe_branch
+        db = sf.get_db_name(branch)
+        point = RollbackPoint(db)
+        state = point.load()
+        timestamp = state['timestamp']
+        sql = config.sql('rollback_base_commit').format(RELEASE_TABLE=self.RELEASE_TABLE,
+                timestamp=timestamp)
+        base_commit = sf.run_single_statament(sql, branch)
+        assert base_commit, f"No release history entry older than {timestamp} in {db}."
+        base_commit = base_commit[0][0]
+
+        logger.info(f"Rolling back {len(state['objects'])} object(s) in {db} to {timestamp} "
+                f"(model at {base_commit}):")
+        if dry_run:
+            for obj in state['objects']:
+                how = 'Time Travel' if obj['type'] == 'TABLE' else 'git definition'
+                logger.info(f"  {obj['type']:<12} {obj['name']:<50} {how}")
+            logger.info("Skipping rollback due to --dry-run.")
+            return
+        if sf.is_production(db) and not force and not yes_or_no(f"Rollback release in {db}"):
+            return
+
+        objects = state['objects']
+        if self.OBJECT_HASH_TABLE:
+            objects = objects + [{'type': 'TABLE', 'name': self.OBJECT_HASH_TABLE.upper()}]
+        failed = []
+        # undo in reverse order, dependent objects are usually created last
+        for obj in reversed(objects):
+            try:
+                if obj['type'] == 'TABLE':
+                    self._rollback_table(obj['name'], timestamp, branch, obj.get('existed', True))
+                else:
+                    self._rollback_object(obj['type'], obj['name'], base_commit, branch)
+            except RuntimeError as e:
+                logger.error(f"  {obj['type']} {obj['name']}: {e}")
+                failed.append(obj)
+
+        if failed:
+            # release is not undone yet: history entries stay, rollback
+            # again retries just the failed objects
+            state['objects'] = [obj for obj in state['objects'] if obj in failed]
+            point.save(state)
+            raise RuntimeError(f"Rollback of {len(failed)} object(s) failed: "
+                    f"{', '.join(obj['name'] for obj in failed)}. Release history is kept, "
+                    "fix the cause and run rollback again to retry them.")
+        sf.run_single_statament(config.sql('rollback_history').format(
+                RELEASE_TABLE=self.RELEASE_TABLE, timestamp=timestamp), branch)
+        point.remove()
+        logger.info("Rollback finished.")
+
+    def _rollback_table(self, name, timestamp, branch, existed=True) -> None:
+        """Restores table with Time Travel clone and swap. Table replaced or
+           dropped by the release is dropped and undropped, table that did
+           not exist before the release is only dropped (UNDROP would bring
+           back an older, unrelated table of that name)."""
+        run = lambda query_id: sf.run_single_statament(config.sql(query_id).format(
+                name=name, tmp=suffixed_name(name, '_ROLLBACK'), timestamp=timestamp), branch)
+        try:
+            run('rollback_clone_table')
+        except RuntimeError as e:
+            if 'does not exist' not in str(e) and 'Time travel data is not available' not in str(e):
+                raise
+            # current table didn't exist at timestamp
+            run('rollback_drop_table')
+            if not existed:
+                logger.info(f"  TABLE {name}: created by the release, dropped")
+                return
+            try:
+                run('rollback_undrop_table')
+                logger.info(f"  TABLE {name}: previous version undropped")
+            except RuntimeError as e:
+                raise RuntimeError(f"dropped, but previous version can't be undropped: {e}")
+            return
+        run('rollback_swap_table')
+        run('rollback_drop_table_tmp')
+        logger.info(f"  TABLE {name}: restored to {timestamp}")
+
+    def _rollback_object(self, o_type, o_name, base_commit, branch) -> None:
+        """Re-applies object definition from model at base commit (drops
+           the object if it was not defined there)."""
+        definition = self._get_definition(o_type, o_name, base_commit)
+        if definition is None:
+            if o_type in ('PROCEDURE', 'FUNCTION'):
+                raise RuntimeError(f"not defined at {base_commit}, drop it by hand "
+                        "(arguments are needed)")
+            sf.run_single_statament(config.sql('rollback_drop_object').format(
+                    o_type=o_type.replace('_', ' '), o_name=o_name), branch)
+            logger.info(f"  {o_type} {o_name}: created by the release, dropped")
+            return
+        filename, sql = definition
+        for statement in split_sql(sql):
+            sf.run_single_statament(statement, branch)
+        logger.info(f"  {o_type} {o_name}: definition from {filename} re-applied")
+
+    def _get_definition(self, o_type, o_name, commit):
+        """Returns (model file, SQL) with CREATE of the object at commit."""
+        short_name = o_name.split('.')[-1].strip('"')
+        for filename in repo.grep_files(short_name, commit, self.MODEL_DIR):
+            sql = repo.get_file_contents_by_commit(filename, commit)
+            for meta in parse_sql(sql):
+                if (meta.verb == 'CREATE' and meta.o_type == o_type
+                        and (meta.o_name == o_name or meta.o_name.endswith('.' + o_name))):
+                    return filename, sql
+        return None
+
+    def compare_branches_and_clones(self, prune=False, dry_run=False, force=False) -> None:
+        branches = {sf.get_db_name(branch) for branch in repo.get_dev_branches()}
         
         clones = sf.get_dev_clones()
+        abandoned = []
         logger.info("|{:_^30}|{:_^18}|{:_^18}|{:_^14}|".format(
             'clone', 'created', 'updated', 'has branch?'))
         for clone in clones:
+            has_branch = clone[0] in branches
+            if not has_branch:
+                abandoned.append(clone[0])
             logger.info("| {:<28.28} | {:%Y-%m-%d %H:%M} | {:%Y-%m-%d %H:%M} | {:^12} |".format(
-                clone[0], clone[1], clone[2], 'yes' if clone[0] in branches else 'no'))
+                clone[0], clone[1], clone[2], 'yes' if has_branch else 'no'))
+
+        if prune:
+            self.prune_clones(abandoned, dry_run=dry_run, force=force)
+
+    def prune_clones(self, clones, dry_run=False, force=False) -> None:
+        """Drops development clones with no matching branch."""
+        if not clones:
+            logger.info("No abandoned clones to prune.")
+            return
+        if dry_run:
+            logger.info(f"Skipping dropping {len(clones)} clone(s) due to --dry-run.")
+            return
+        if not force and not yes_or_no(f"Drop {len(clones)} abandoned clone(s)"):
+            return
+
+        workers = int(config.read_config('prune_workers', default='8'))
+        logger.info(f"Dropping {len(clones)} clone(s) using {workers} concurrent sessions:")
+        failed = sf.drop_clones(clones, workers)
+        if failed:
+            raise RuntimeError(f"Failed to drop {len(failed)} clone(s): {', '.join(failed)}")
+        logger.info("Pruning finished")
 
     def _gen_release_filename(self) -> str:
         """Generates release filename based on branch."""
@@ -0,0 +1,99 @@
+import os
+import json
+from uuid import uuid4
+
+from .log import logger
+from .config import config
+from .sql import parse_sql, object_key, DDL_VERBS
+
+
+class RollbackPoint():
+    """State of a database before the last sync or deploy run: server
+       timestamp taken right before its first release started and objects
+       touched by statements of all its releases. Kept in a local file (one
+       per database) and used by `rollback` action."""
+
+    ROLLBACK_DIR = '.rollback'
+    DML_VERBS    = {'INSERT', 'UPDATE', 'DELETE', 'MERGE', 'COPY'}
+    RUN          = None
+
+    def __init__(self, db):
+        self.db = db
+        self.path = os.path.join(self.ROLLBACK_DIR, f"{db}.json")
+
+    @classmethod
+    def new_run(cls) -> None:
+        """Starts a new run: the next release in each database replaces its
+           rollback point, the following ones of the run add to it."""
+        cls.RUN = uuid4().hex
+
+    def record(self, cur, statements) -> None:
+        """Records current server timestamp (using release cursor) and objects
+           touched by statements, with tables existing at that moment. Within
+           a run the timestamp of the first release is kept and objects are
+           added."""
+        point = self._read()
+        if self.RUN is None or point is None or point.get('run') != self.RUN:
+            cur.execute(config.sql('current_timestamp'))
+            point = {'db': self.db, 'run': self.RUN, 'timestamp': cur.fetchone()[0], 'objects': []}
+        objects = {f"{obj['type']}#{obj['name']}": obj for obj in point['objects']}
+        new_tables = []
+        for statement in statements:
+            for meta in parse_sql(statement):
+                touched = self.touched_object(meta)
+                if touched:
+                    o_type, o_name = touched
+                    key = f"{o_type}#{o_name}"
+                    if key not in objects:
+                        objects[key] = {'type': o_type, 'name': o_name, 'verbs': []}
+                        if o_type == 'TABLE':
+                            new_tables.append(objects[key])
+                    objects[key]['verbs'].append(meta.verb)
+        if new_tables:
+            existing = self._existing_tables(cur, [table['name'] for table in new_tables])
+            for table in new_tables:
+                table['existed'] = object_key('TABLE', table['name']) in existing
+        point['objects'] = list(objects.values())
+        self.save(point)
+
+    def save(self, point) -> None:
+        os.makedirs(self.ROLLBACK_DIR, exist_ok=True)
+        with open(self.path, 'w') as point_file:
+            json.dump(point, point_file, indent=1)
+        logger.debug(f"Rollback point {point['timestamp']} with {len(point['objects'])} object(s) "
+                f"written to {self.path}.")
+
+    @staticmethod
+    def _existing_tables(cur, names) -> set:
+        """Returns TABLE#SCHEMA.NAME keys of names that are existing tables."""
+        bare = {object_key('TABLE', name).split('.')[-1] for name in names}
+        cur.execute(config.sql('rollback_existing_tables').format(
+                names=', '.join("'" + name.replace("'", "''") + "'" for name in sorted(bare))))
+        return {object_key('TABLE', f"{schema}.{name}") for schema, name in cur.fetchall()}
+
+    @classmethod
+    def touched_object(cls, meta):
+        """Returns (type, name) of object changed by statement (or None)."""
+        if meta.verb in DDL_VERBS and meta.o_type and meta.o_name:
+            return meta.o_type, meta.o_name
+        if meta.verb in cls.DML_VERBS and meta.references:
+            # INSERT INTO / UPDATE / DELETE FROM / MERGE INTO target first
+            return 'TABLE', meta.references[0]
+        return None
+
+    def load(self) -> dict:
+        """Returns recorded rollback point."""
+        point = self._read()
+        if point is None:
+            raise RuntimeError(f"No rollback point for {self.db} ({self.path} missing). "
+                    "Rollback is possible only from the place the release was run.")
+        return point
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r') as point:
+            return json.load(point)
+
+    def remove(self) -> None:
+        os.remove(self.path)
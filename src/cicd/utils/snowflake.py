@@ -1,4 +1,9 @@
 import re
+import sys
+import threading
+from time import sleep, time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, CancelledError, as_completed
 
 import snowflake.connector as sfc
 from snowflake.connector.errors import Error as SfError
@@ -10,8 +15,16 @@ from cryptography.hazmat.primitives import serialization
 
 from .log import logger, is_debug
 from .config import config
-from .sql import split_sql, print_sql, RESUME_TASK
+from .sql import split_sql_hints, print_sql, parse_sql, ddl_fingerprints, object_key, sql_string, \
+        RESUME_TASK, SESSION_STATE, AUTOCOMMIT_VERBS, DDL_VERBS
 from .utils import yes_or_no
+from .journal import Journal
+from .rollback import RollbackPoint
+from .metrics import metrics
+from .ddl_cache import DDLCache
+from .backfill import Backfill
+from .async_query import AsyncQuery
+from .query_stats import query_stats
 
 class Snowflake():
     """Snowflake connector wrapper."""
@@ -19,13 +32,41 @@ class Snowflake():
     SF_VALID_NAME = re.compile(r'^[\w-]+$')
     SF_PROD_NAME = config.read_config('production_db')
     SF_STAGING_NAME = config.read_config('staging_db')
+    SF_TARGETS = [db.strip().upper() for db in
+                  config.read_config('deploy_targets', default='').split(',') if db.strip()]
+    FETCH_SIZE = int(config.read_config('fetch_size', default='10000'))
+    WARM_UP    = config.read_config('warm_up', default='true').lower() in ('true', 'yes', '1')
+    DDL_CACHE_BULK = int(config.read_config('ddl_cache_bulk', default='3'))
 
     def __init__(self):
         self._conn = None
+        self._sessions = {}
+        # kept sessions a release may have left with other role, warehouse
+        # or session parameters, they are not reused
+        self._dirty_sessions = set()
+        self.keep_sessions = False
+        self._warm = None
+        self._warm_lock = threading.Lock()
+        self.ddl_cache = DDLCache()
+        self._last_altered = {}
+        self._ddl_requests = {}
 
-    def connect(self, branch):
-        """Connect to the DB and returns connection."""
-        db = self.get_db_name(branch)
+    def connect(self, branch, db=None):
+        """Connect to the DB (branch database unless db given) and returns connection."""
+        db = db or self.get_db_name(branch)
+        conn = self._take_warm_connection(db)
+        if conn is not None:
+            return conn
+        try:
+            with metrics.timer('snowflake_login_seconds', background='false'):
+                return self._connect(db)
+        except DatabaseError as de:
+            metrics.inc('snowflake_login_failures')
+            if "250001 (08001)" in str(de):
+                logger.info("Is this your first run in this branch and the database was not cloned? Try 'clone' first.")
+            raise RuntimeError(de)
+
+    def _connect(self, db):
         key = self._get_key(config.read_user_config('private_key_file'))
         user = config.read_user_config('user')
         warehouse = config.read_config('warehouse')
@@ -33,43 +74,175 @@ class Snowflake():
         logger.debug("Connecting to Snowflake database {} as {}".format(db,
             user))
         logger.debug("Role {}, warehouse {}".format(role, warehouse))
-        try:
-            if not key:
-                logger.warning('Connecting to Snowflake using password. Please use key-pair auth instead.')
-                return sfc.connect(password=config.read_user_config('password'),
-                        user=user,
-                        account=config.read_config('account'),
-                        warehouse=warehouse,
-                        database=db,
-                        autocommit=False,
-                        role=role,
-                        validate_default_parameters=True,
-                        schema='PUBLIC')
-            return sfc.connect(private_key=key,
+        if not key:
+            logger.warning('Connecting to Snowflake using password. Please use key-pair auth instead.')
+            return sfc.connect(password=config.read_user_config('password'),
                     user=user,
                     account=config.read_config('account'),
                     warehouse=warehouse,
                     database=db,
                     autocommit=False,
                     role=role,
-                    #validate_default_parameters=True,
+                    validate_default_parameters=True,
                     schema='PUBLIC')
-        except DatabaseError as de:
-            if "250001 (08001)" in str(de):
-                logger.info("Is this your first run in this branch and the database was not cloned? Try 'clone' first.")
-            raise RuntimeError(de)
+        return sfc.connect(private_key=key,
+                user=user,
+                account=config.read_config('account'),
+                warehouse=warehouse,
+                database=db,
+                autocommit=False,
+                role=role,
+                #validate_default_parameters=True,
+                schema='PUBLIC')
+
+    def warm_up(self, branch):
+        """Speculatively connects to the branch database and resumes the
+           warehouse in background, overlapping it with local git and parsing
+           work. The first connect() to that database picks the connection up."""
+        if not self.WARM_UP:
+            return
+        db = self.get_db_name(branch)
+        if db in self._sessions or self._warm is not None:
+            return
+        executor = ThreadPoolExecutor(max_workers=1)
+        self._warm = (db, executor.submit(self._warm_connect, db))
+        executor.shutdown(wait=False)
+
+    def _warm_connect(self, db):
+        """Returns authenticated connection with warehouse resumed (or None)."""
+        try:
+            with metrics.timer('snowflake_login_seconds', background='true'):
+                conn = self._connect(db)
+        except Exception as e:
+            logger.debug(f"Warm-up connection to {db} failed: {e}")
+            return None
+        try:
+            conn.cursor().execute(config.sql('resume_warehouse').format(
+                    warehouse=config.read_config('warehouse')))
+        except SfError as e:
+            # e.g. no OPERATE privilege, first query resumes the warehouse then
+            logger.debug(f"Warm-up of warehouse failed: {e}")
+        return conn
+
+    def _take_warm_connection(self, db):
+        """Returns warmed up connection to db (waiting for it) or None."""
+        with self._warm_lock:
+            if self._warm is None or self._warm[0] != db:
+                return None
+            future, self._warm = self._warm[1], None
+        return future.result()
+
+    def discard_warm_up(self):
+        """Closes warmed up connection nobody used."""
+        with self._warm_lock:
+            warm, self._warm = self._warm, None
+        if warm is not None:
+            conn = warm[1].result()
+            if conn is not None:
+                conn.close()
 
-    def perform_release(self, sql, branch):
-        """Run arbitrary SQL statement(s)."""
-        conn = self.connect(branch)
-        skip_resume_task = (self.get_db_name(branch) != self.SF_PROD_NAME)
+    def session(self, branch, db=None):
+        """Returns a connection to the branch database. When sessions are kept
+           alive (daemon mode) an already authenticated one is reused, unless
+           a release changed its state (see _track_session_state)."""
+        if not self.keep_sessions:
+            return self.connect(branch, db)
+        db = db or self.get_db_name(branch)
+        conn = self._sessions.get(db)
+        if conn in self._dirty_sessions:
+            self._dirty_sessions.discard(conn)
+            conn.close()
+            conn = None
+        if conn is not None and not conn.is_closed():
+            try:
+                # release may have switched database/schema with USE statements
+                conn.cursor().execute(config.sql('use_schema').format(db=db))
+                return conn
+            except SfError:
+                # database was dropped or recreated in the meantime
+                conn.close()
+        conn = self._sessions[db] = self.connect(branch, db)
+        return conn
+
+    def release_session(self, conn):
+        """Closes connection unless sessions are kept alive."""
+        if not self.keep_sessions:
+            conn.close()
+
+    @contextmanager
+    def kept_sessions(self):
+        """Reuses one session per database within the block."""
+        kept = self.keep_sessions
+        self.keep_sessions = True
+        try:
+            yield
+        finally:
+            self.keep_sessions = kept
+            if not kept:
+                self.close_sessions()
+
+    def close_sessions(self):
+        """Closes all the kept alive connections."""
+        for conn in self._sessions.values():
+            conn.close()
+        self._sessions = {}
+        self._dirty_sessions = set()
+
+    def _track_session_state(self, conn, statement, meta) -> None:
+        """Marks kept session dirty if statement may change its role,
+           warehouse or session parameters (USE, ALTER SESSION, procedures
+           and EXECUTE IMMEDIATE)."""
+        if self.keep_sessions and (SESSION_STATE.search(statement)
+                                   or (meta and meta[0].verb in ('CALL', 'EXECUTE'))):
+            self._dirty_sessions.add(conn)
+
+    def perform_release(self, sql, branch, db=None, resume=False, label=None):
+        """Run arbitrary SQL statement(s). Statements are checkpointed in
+           a journal, with resume=True statements applied by previous failed
+           run of the same release are skipped."""
+        statements, hints = split_sql_hints(sql)
+        self.perform_statements(statements, branch, db=db, resume=resume, hints=hints, label=label)
+
+    def perform_statements(self, statements, branch, db=None, resume=False, hints=None, label=None):
+        """Runs already split SQL statements in a single release transaction.
+           Each statement is tagged (QUERY_TAG) with release hash, label
+           (release file) and statement number, its query ID is recorded.
+           Statements with a warehouse hint ({index: {'warehouse': NAME}}) are
+           run on that warehouse, switching back to the default one afterwards.
+           Statements with a chunk hint are committed in chunks (see Backfill),
+           so the transaction is committed before and started again after them."""
+        db = db or self.get_db_name(branch)
+        hints = hints or {}
+        default_warehouse = config.read_config('warehouse')
+        journal = Journal(db, statements, connect=lambda: self.connect(branch, db))
+        if resume:
+            applied = journal.resume_point()
+        else:
+            applied = 0
+            journal.warn_stale()
+        conn = self.session(branch, db)
+        skip_resume_task = not self.is_production(db)
         cur = conn.cursor()
         try:
+            # bad hints have to fail the release before anything is committed
+            Backfill.check(statements, {i: hint for i, hint in hints.items() if i >= applied}, cur)
             cur.execute(config.sql('autocommit'))
             cur.execute(config.sql('transaction_abort'))
+            if not applied:
+                # resumed release keeps rollback point of its first run
+                RollbackPoint(db).record(cur, statements)
             logger.debug('BEGIN TRANSACTION')
             cur.execute(config.sql('transaction_begin'))
-            for statement in split_sql(sql):
+            journal.start(applied, resume)
+            durable = applied - 1
+            for i, statement in enumerate(statements):
+                if i < applied:
+                    # already applied, but session state has to be restored
+                    if SESSION_STATE.search(statement):
+                        self._track_session_state(conn, statement, None)
+                        cur.execute(statement)
+                    metrics.inc('statements_skipped')
+                    continue
                 if skip_resume_task and RESUME_TASK.search(statement):
                     logger.info("Skipping '{}' statement as this is not production".format(
                         statement.replace("\n", " ")))
@@ -77,30 +250,92 @@ class Snowflake():
                 logger.debug('  running statement:')
                 if is_debug():
                     print_sql(statement)
+                warehouse = hints.get(i, {}).get('warehouse')
+                if hints.get(i, {}).get('chunk'):
+                    # chunk sessions have to see everything before the statement
+                    cur.execute(config.sql('commit'))
+                    if i:
+                        journal.checkpoint(i - 1)
+                    metrics.inc('statements_executed')
+                    try:
+                        Backfill(statement, hints[i]['chunk'], journal, i,
+                                 connect=lambda: self.connect(branch, db),
+                                 session_state=[s for s in statements[:i] if SESSION_STATE.search(s)],
+                                 warehouse=warehouse, label=label).run()
+                    except SfError:
+                        logger.error(f"Release failed due to this statement (#{i + 1} of {len(statements)}):")
+                        print_sql(statement)
+                        raise
+                    journal.checkpoint(i)
+                    durable = i
+                    cur.execute(config.sql('transaction_begin'))
+                    continue
+                meta = parse_sql(statement)
+                autocommits = bool(meta) and meta[0].verb in AUTOCOMMIT_VERBS
+                if autocommits and durable < i - 1:
+                    # DDL commits the open transaction even if it fails itself,
+                    # so the statements before it are made durable first
+                    cur.execute(config.sql('commit'))
+                    journal.checkpoint(i - 1)
+                    durable = i - 1
+                self._track_session_state(conn, statement, meta)
                 try:
-                    cur.execute(statement)
+                    if warehouse:
+                        logger.info(f"  running statement #{i + 1} on warehouse {warehouse}")
+                        cur.execute(config.sql('use_warehouse').format(warehouse=warehouse))
+                    try:
+                        tag = query_stats.tag(journal.release_hash, label, i)
+                        cur.execute(query_stats.set_tag_sql(tag))
+                        metrics.inc('statements_executed')
+                        query_id = None
+                        try:
+                            with metrics.timer('statement_seconds'):
+                                cur.execute(statement)
+                            query_id = cur.sfqid
+                        except SfError as e:
+                            # the failing statement is the one worth looking at
+                            query_id = e.sfqid
+                            raise
+                        finally:
+                            query_stats.record(db, query_id, tag)
+                    finally:
+                        if warehouse:
+                            cur.execute(config.sql('use_warehouse').format(warehouse=default_warehouse))
                 except SfError as e:
                     if 'Empty SQL statement' in str(e):
                         logger.warning("Found empty SQL statement. Too many ';' in file?")
                     else:
-                        logger.error("Release failed due to this statement:")
+                        logger.error(f"Release failed due to this statement (#{i + 1} of {len(statements)}):")
                         print_sql(statement)
                         raise
                 if cur.rowcount:
                     logger.info("  " + str(cur.fetchone())[1:-1])
+                if autocommits:
+                    journal.checkpoint(i)
+                    durable = i
             logger.debug('COMMIT TRANSACTION')
             cur.execute(config.sql('commit'))
+            journal.finish()
+            self._last_altered.pop(db, None)
         except SfError as e:
+            metrics.inc('release_failures')
             logger.debug('ROLLBACK TRANSACTION')
             conn.rollback()
             logger.error('Error while running the release:')
+            logger.info(f"Applied statements are recorded in {journal.path}, rerun with --resume to continue.")
             raise RuntimeError(e)
         finally:
-            conn.close()
+            journal.close()
+            try:
+                # kept sessions must not tag later queries as release ones
+                cur.execute(config.sql('unset_query_tag'))
+            except SfError as e:
+                logger.debug(f"Can't unset query tag: {e}")
+            self.release_session(conn)
 
-    def run_single_statament(self, query, branch='main'):
+    def run_single_statament(self, query, branch='main', db=None):
         """Runs single SQL statement against Snowflake."""
-        conn = self.connect(branch)
+        conn = self.session(branch, db)
         cur = conn.cursor()
         try:
             if is_debug():
@@ -114,10 +349,109 @@ class Snowflake():
                 logger.info("Is this your first run in this branch and the database was not cloned? Try 'clone' first.")
             raise RuntimeError(e)
         finally:
-            conn.close()
+            self.release_session(conn)
+
+    def query_history(self, db, query_ids, since):
+        """Returns QUERY_HISTORY rows of query IDs run in db since (epoch).
+           History is read through production database, release database
+           may be gone already (test_sync drops its clone), so rows are
+           filtered by DATABASE_NAME of db."""
+        query_ids = ', '.join(f"'{query_id}'" for query_id in query_ids)
+        return self.run_single_statament(config.sql('query_history').format(db=self.SF_PROD_NAME,
+                database=sql_string(db.upper()), query_ids=query_ids, since=int(since)))
+
+    def fetch_batches(self, query, branch='main', db=None):
+        """Runs single SQL query and yields its result in batches (lists of
+           rows) instead of loading the whole result set. Uses connector's
+           result batches (Arrow chunks downloaded one at a time) when
+           available, fetchmany(fetch_size) when the cursor has no result
+           batches (older connector, result not split into batches)."""
+        conn = self.session(branch, db)
+        cur = conn.cursor()
+        try:
+            if is_debug():
+                print_sql(query)
+            cur.execute(query)
+            get_result_batches = getattr(cur, 'get_result_batches', None)
+            batches = get_result_batches() if get_result_batches else None
+            if batches is None:
+                while True:
+                    rows = cur.fetchmany(self.FETCH_SIZE)
+                    if not rows:
+                        break
+                    yield rows
+            else:
+                for batch in batches:
+                    yield list(batch)
+        except SfError as e:
+            if "This session does not have a current database" in str(e):
+                logger.info("Is this your first run in this branch and the database was not cloned? Try 'clone' first.")
+            raise RuntimeError(e)
+        finally:
+            cur.close()
+            self.release_session(conn)
+
+    def iter_rows(self, query, branch='main', db=None):
+        """Yields query result row by row, fetched in batches."""
+        for batch in self.fetch_batches(query, branch, db):
+            yield from batch
 
-    def clone_production(self, branch, force=False):
-        """Clones production database into new db named after branch name."""
+    def get_targets(self):
+        """Returns databases configured for multi-target deploy."""
+        assert self.SF_TARGETS, "No deploy_targets configured, can't use --targets."
+        for db in self.SF_TARGETS:
+            assert self.SF_VALID_NAME.match(db), f"{db} is not a valid Snowflake identifier"
+        return self.SF_TARGETS
+
+    def fan_out(self, dbs, task):
+        """Runs task(db) for all the databases concurrently and reports
+           per database result. Returns dict of failed databases and errors.
+           With deploy_failure_policy=abort the first failure cancels
+           databases not started yet."""
+        policy = self.failure_policy()
+        workers = int(config.read_config('deploy_workers', default='8'))
+
+        failed = {}
+        if not dbs:
+            return failed
+        with ThreadPoolExecutor(max_workers=min(workers, len(dbs))) as pool:
+            futures = {pool.submit(task, db): db for db in dbs}
+            for done, future in enumerate(as_completed(futures), 1):
+                db = futures[future]
+                try:
+                    future.result()
+                    logger.info(f"  [{done}/{len(dbs)}] {db}: OK")
+                except CancelledError:
+                    failed[db] = 'cancelled'
+                    logger.warning(f"  [{done}/{len(dbs)}] {db}: cancelled")
+                except (RuntimeError, AssertionError) as e:
+                    failed[db] = e
+                    logger.error(f"  [{done}/{len(dbs)}] {db}: FAILED {e}")
+                    if policy == 'abort':
+                        for pending in futures:
+                            pending.cancel()
+
+        logger.info("|{:_^32}|{:_^12}|".format('database', 'result'))
+        for db in dbs:
+            logger.info("| {:<30.30} | {:^10} |".format(db,
+                'ok' if db not in failed else 'cancelled' if failed[db] == 'cancelled' else 'FAILED'))
+        return failed
+
+    def failure_policy(self):
+        """Returns multi-target deploy failure policy: 'continue' or 'abort'."""
+        policy = config.read_config('deploy_failure_policy', default='continue')
+        assert policy in ('continue', 'abort'), (f"Unknown deploy_failure_policy {policy}, "
+                "use 'continue' or 'abort'")
+        return policy
+
+    def is_production(self, db):
+        """Checks if db is production (or one of production deploy targets)."""
+        return db == self.SF_PROD_NAME or db.strip().upper() in self.SF_TARGETS
+
+    def clone_production(self, branch, force=False, wait=True):
+        """Clones production database into new db named after branch name.
+           Clone is submitted asynchronously, with wait=False it's not waited
+           for (see `status` action)."""
         newdb = self.get_db_name(branch)
         assert self.SF_VALID_NAME.match(newdb), (f"{newdb} is not a valid Snowflake"
                 " identifier")
@@ -137,27 +471,148 @@ class Snowflake():
         logger.info(f"Cloning {self.SF_PROD_NAME} into {newdb}")
 
         sql = config.sql('create_clone').format(newdb=newdb, prod=self.SF_PROD_NAME)
-        self.run_single_statament(sql)
+        self.ddl_cache.clear(newdb)
+        self._last_altered.pop(newdb, None)
+        self.submit_async(sql, newdb, 'clone')
+        if not wait:
+            logger.info("Not waiting for the clone, run 'status' to collect it.")
+            return
+        self.wait_async(newdb)
         logger.info("Cloning finished")
     
-    def drop_clone(self, branch, force=False):
-        """Drops clone."""
+    def drop_clone(self, branch, force=False, wait=True):
+        """Drops clone (asynchronously, see clone_production)."""
         db = self.get_db_name(branch)
+        self._assert_droppable(db, force)
+        
+        logger.info(f"Dropping clone {db}")
+
+        self.ddl_cache.clear(db)
+        self.submit_async(config.sql('drop_clone').format(db=db), db, 'drop')
+        if not wait:
+            logger.info("Not waiting for the drop, run 'status' to collect it.")
+            return
+        self.wait_async(db)
+        logger.info("Dropping clone finished")
+
+    def submit_async(self, sql, db, operation) -> str:
+        """Submits statement changing db without waiting for its result.
+           Query ID is persisted, returns it."""
+        if AsyncQuery(db).load():
+            logger.info(f"Previous operation on {db} is not collected yet.")
+            self.wait_async(db)
+        conn = self.session('main')
+        try:
+            if is_debug():
+                print_sql(sql)
+            cur = conn.cursor()
+            cur.execute_async(sql)
+        except SfError as e:
+            raise RuntimeError(e)
+        finally:
+            # submitted query keeps running after the session is closed
+            self.release_session(conn)
+        AsyncQuery(db).save(operation, cur.sfqid)
+        logger.info(f"Submitted {operation} of {db} (query ID {cur.sfqid}).")
+        return cur.sfqid
+
+    def async_status(self, db):
+        """Returns (operation, query ID, status name, is still running) of
+           operation submitted on db or None."""
+        pending = AsyncQuery(db).load()
+        if pending is None:
+            return None
+        conn = self.session('main')
+        try:
+            status = conn.get_query_status(pending['query_id'])
+        except SfError as e:
+            raise RuntimeError(e)
+        finally:
+            self.release_session(conn)
+        return pending['operation'], pending['query_id'], status.name, conn.is_still_running(status)
+
+    def wait_async(self, db) -> None:
+        """Polls operation submitted on db (if any) with backoff until it
+           finishes. Raises if it failed."""
+        query = AsyncQuery(db)
+        pending = query.load()
+        if pending is None:
+            return
+        operation, query_id = pending['operation'], pending['query_id']
+        conn = self.session('main')
+        try:
+            delay = AsyncQuery.POLL_MIN
+            while True:
+                status = conn.get_query_status(query_id)
+                if not conn.is_still_running(status):
+                    break
+                logger.info(f"  {operation} of {db}: {status.name.lower()}, "
+                        f"{time() - pending['submitted']:.0f}s since submitted")
+                sleep(delay)
+                delay = min(delay * 2, AsyncQuery.POLL_MAX)
+            query.remove()
+            metrics.observe('async_seconds', time() - pending['submitted'], operation=operation)
+            if conn.is_an_error(status):
+                conn.get_query_status_throw_if_error(query_id)
+                raise RuntimeError(f"{operation} of {db} failed ({status.name}), query ID {query_id}.")
+        except SfError as e:
+            # reported here, a stale query ID must not fail every later run
+            query.remove()
+            raise RuntimeError(f"{operation} of {db} failed: {e}")
+        finally:
+            self.release_session(conn)
+
+    def drop_clones(self, dbs, workers):
+        """Drops development clones (database names) through a bounded pool of
+           concurrent sessions. Returns list of clones that failed to drop."""
+        for db in dbs:
+            self._assert_droppable(db)
+            assert db.startswith('_DEV_'), f"{db} is not a development clone"
+
+        local = threading.local()
+        sessions = []
+        lock = threading.Lock()
+
+        def drop(db):
+            if not hasattr(local, 'conn'):
+                local.conn = self.connect('main')
+                with lock:
+                    sessions.append(local.conn)
+            try:
+                local.conn.cursor().execute(config.sql('drop_clone').format(db=db))
+                self.ddl_cache.clear(db)
+            except SfError as e:
+                raise RuntimeError(e)
+
+        failed = []
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(drop, db): db for db in dbs}
+                for done, future in enumerate(as_completed(futures), 1):
+                    db = futures[future]
+                    try:
+                        future.result()
+                        logger.info(f"  [{done}/{len(dbs)}] dropped clone {db}")
+                    except RuntimeError as e:
+                        logger.error(f"  [{done}/{len(dbs)}] can't drop clone {db}: {e}")
+                        failed.append(db)
+        finally:
+            for conn in sessions:
+                conn.close()
+        return failed
+
+    def _assert_droppable(self, db, force=False):
+        """Safety checks performed before dropping any database."""
         assert self.SF_VALID_NAME.match(db), (f"{db} is not a valid Snowflake"
                 " identifier")
         assert db.strip().upper() != self.SF_PROD_NAME, ("Never ever drop production!")     
         assert db.strip().upper() != self.SF_STAGING_NAME or force, (
                 f"Trying to drop {self.SF_STAGING_NAME} without --force.")
-        
-        logger.info(f"Dropping clone {db}")
-
-        self.run_single_statament(f'DROP DATABASE {db};')
-        logger.info("Dropping clone finished")
 
     def get_dev_clones(self):
-        """Returns all development clones""" 
+        """Yields all development clones."""
         sql = config.sql('get_dev_clones')
-        return self.run_single_statament(sql)
+        return self.iter_rows(sql)
     
     def get_altered_objects(self, branch):
         """Returns all objects changed since clone creation."""
@@ -166,33 +621,127 @@ class Snowflake():
         return self.run_single_statament(sql, branch)
     
     def get_all_objects(self, branch):
+        """Returns {TYPE#SCHEMA.NAME: (schema.name, type, last altered)} of
+           all objects in branch database, consuming query results batch by
+           batch so only the compact entries are kept in memory. SHOW STREAMS
+           and SHOW TASKS have no LAST_ALTERED, created_on is given for them."""
         db = self.get_db_name(branch)
-        sql = config.sql('get_all_objects').format(db=db)
-        all_objects = self.run_single_statament(sql, branch)
+        dictionary = self._get_schema_objects(branch)
+
+        def add(schema, name, o_type, last_altered):
+            o_name = f"{schema}.{name}"
+            o_type = sys.intern(o_type)
+            dictionary[f"{o_type.replace(' ', '_')}#{o_name}".upper()] = (o_name, o_type, last_altered)
 
         sql = config.sql('get_streams').format(db=db)
-        streams = self.run_single_statament(sql, branch)
-        for stream in streams:
-            all_objects += [(stream[3], stream[1], 'STREAM', stream[0])]
+        for stream in self.iter_rows(sql, branch):
+            add(stream[3], stream[1], 'STREAM', stream[0])
 
         sql = config.sql('get_tasks').format(db=db)
-        tasks = self.run_single_statament(sql, branch)
-        for task in tasks:
-            all_objects += [(task[4], task[1], 'TASK', task[0])]
-        
-        dictionary = {}
-        for obj in all_objects:
-            dictionary[(obj[2].replace(' ', '_') + '#' + obj[0] + '.' + obj[1]).upper()] = (obj[0] + '.' + obj[1], obj[2], obj[3])
+        for task in self.iter_rows(sql, branch):
+            add(task[4], task[1], 'TASK', task[0])
+
+        return dictionary
 
+    def _get_schema_objects(self, branch, signatures=False) -> dict:
+        """Returns {TYPE#SCHEMA.NAME: (schema.name, type, LAST_ALTERED)} of
+           objects listed in INFORMATION_SCHEMA (single query). With
+           signatures=True keys of functions and procedures end with their
+           argument signature, so overloads don't share one entry."""
+        db = self.get_db_name(branch)
+        dictionary = {}
+        for schema, name, o_type, last_altered, signature in self.iter_rows(
+                config.sql('get_all_objects').format(db=db), branch):
+            o_name = f"{schema}.{name}"
+            o_type = sys.intern(o_type)
+            key = f"{o_type.replace(' ', '_')}#{o_name}".upper()
+            if signatures and signature:
+                key += signature.upper()
+            dictionary[key] = (o_name, o_type, last_altered)
         return dictionary
     
+    def get_ddl_fingerprints(self, branch, db=None) -> dict:
+        """Returns {TYPE#SCHEMA.NAME: fingerprint} of all objects in database,
+           read with a single GET_DDL of the whole database."""
+        db = db or self.get_db_name(branch)
+        sql = config.sql('get_database_ddl').format(db=db)
+        return ddl_fingerprints(self.run_single_statament(sql, branch, db)[0][0])
+
+    def refresh_ddl_fingerprints(self, fingerprints, sql, branch, db=None) -> None:
+        """Updates fingerprints (see get_ddl_fingerprints) after sql was run:
+           objects it creates or alters are read again with GET_DDL of each
+           object, dropped ones are removed. Objects that can't be read alone
+           (e.g. overloaded functions) are just removed, so they're not
+           skipped. CALL or EXECUTE IMMEDIATE may change anything, the whole
+           database is read again then."""
+        statements = parse_sql(sql)
+        if any(meta.verb in ('CALL', 'EXECUTE') for meta in statements):
+            fingerprints.clear()
+            fingerprints.update(self.get_ddl_fingerprints(branch, db))
+            return
+        for meta in statements:
+            if meta.verb not in DDL_VERBS or not meta.o_type or not meta.o_name:
+                continue
+            if '.' in meta.o_name:
+                fingerprints.pop(object_key(meta.o_type, meta.o_name), None)
+            else:
+                # schema may be set by USE SCHEMA, drop the name in every schema
+                suffix = '.' + meta.o_name.strip('"').upper()
+                for key in [key for key in fingerprints
+                            if key.startswith(meta.o_type + '#') and key.endswith(suffix)]:
+                    del fingerprints[key]
+            if meta.verb == 'DROP':
+                continue
+            o_type = meta.o_type.replace('_', ' ')
+            sql = config.sql('get_object_ddl').format(o_type=o_type, o_name=meta.o_name,
+                    parameters="()" if o_type == "PROCEDURE" else "")
+            try:
+                fingerprints.update(ddl_fingerprints(self.run_single_statament(sql, branch, db)[0][0]))
+            except RuntimeError as e:
+                logger.debug(f"Can't read {o_type} {meta.o_name} definition: {e}")
+
     def get_ddl(self, branch, o_type, o_name) -> str:
-        """Returns object DDL."""
+        """Returns object DDL, from on-disk cache if object's LAST_ALTERED
+           didn't change since it was cached. LAST_ALTERED of all objects is
+           read (one query) only once `ddl_cache_bulk` DDLs were requested
+           in a run, a single `compare --file` runs GET_DDL alone."""
         if o_type.lower() == 'stage':
             return f'Unable to get DDL for stage {o_name}'
-        sql = config.sql('get_ddl').format(o_type=o_type, o_name=o_name,
-                                           parameters="()" if o_type=="PROCEDURE" else "")
-        return self.run_single_statament(sql, branch)[0][0]
+        db = self.get_db_name(branch)
+        parameters = "()" if o_type == "PROCEDURE" else ""
+        # GET_DDL reads the overload with these (no) arguments, so does the cache
+        key = object_key(o_type, o_name) + parameters
+        self._ddl_requests[db] = self._ddl_requests.get(db, 0) + 1
+        last_altered = None
+        if self._ddl_requests[db] >= self.DDL_CACHE_BULK:
+            last_altered = self.get_last_altered(branch).get(key)
+        if last_altered is not None:
+            ddl = self.ddl_cache.get(db, key, last_altered)
+            if ddl is not None:
+                metrics.inc('ddl_cache_hits')
+                return ddl
+        metrics.inc('ddl_cache_misses')
+        sql = config.sql('get_ddl').format(o_type=o_type, o_name=o_name, parameters=parameters)
+        ddl = self.run_single_statament(sql, branch)[0][0]
+        if last_altered is not None:
+            self.ddl_cache.put(db, key, last_altered, ddl)
+        return ddl
+
+    def get_last_altered(self, branch) -> dict:
+        """Returns {TYPE#SCHEMA.NAME: LAST_ALTERED} of objects in branch
+           database (functions and procedures keyed with argument signature),
+           queried in bulk once per run (and after each release). Streams
+           and tasks have no LAST_ALTERED, so they are not cached."""
+        db = self.get_db_name(branch)
+        if db not in self._last_altered:
+            self._last_altered[db] = {key: obj[2] for key, obj
+                                      in self._get_schema_objects(branch, signatures=True).items()}
+        return self._last_altered[db]
+
+    def forget_last_altered(self) -> None:
+        """Drops LAST_ALTERED read by previous run (daemon outlives runs)."""
+        self._last_altered = {}
+        self._ddl_requests = {}
 
     def get_db_name(self, branch):
         """Converts branch name into database name to operate on."""
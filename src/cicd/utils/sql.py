@@ -1,29 +1,54 @@
 import re
 from io import StringIO
+from itertools import islice
+from collections import namedtuple
 
 import sqlparse
 from termcolor import colored, cprint
 
-from .utils import get_file_contents
+from .utils import get_file_contents, hexDigest
 from .log import logger
 
 TABLE_DIR    = re.compile(r'/tables?/', re.I)
 CREATE_TABLE = re.compile(r'create\s+((or\s+replace\s+)|(if\s+not\s+exists\s+))?table', re.I)
 
-OR_REPLACE   = re.compile(r'create\s+or\s+replace\s+', re.I)
-IF_NOT_EXISTS= re.compile(r'create\s+if\s+not\s+exists\s+', re.I)
-
 OBJECT_TYPE  = (r'procedure|function|table|external\s+table|sequence|'
                 r'view|materialized\s+view|file\s+format|stage|pipe|stream|task')
 TYPE         = re.compile(OBJECT_TYPE, re.I)
-TYPE_NAME    = re.compile(r'create\s+(or\s+replace\s+)?(if\s+not\s+exists\s+)?'
-                          r'(local\s+|global\s+)?(temp\s+|temporary\s+|volatile\s+)?(transient\s+)?'
-                          r'(?P<o_type>' + OBJECT_TYPE + r')\s+(?P<o_name>[\.\w-]+)', re.I)
-DROP         = re.compile(r'drop\s+(' + OBJECT_TYPE + ')', re.I)
 
 TYPE_DIR     = re.compile(r'/(?P<dir_type>' + OBJECT_TYPE.replace(r'\s+', '.') + r')s?/')
 
 RESUME_TASK  = re.compile(r"alter\s+task\s+[\.\w-]+\s+resume\s*;",re.I)
+SESSION_STATE= re.compile(r"^\s*(use|alter\s+session)\s", re.I)
+STATEMENT_HINT = re.compile(r"^--\.(?P<hint>WAREHOUSE|CHUNK):[ \t]*(?P<value>[^\n]*?)\s*$", re.I | re.M)
+HINT_VALUE   = {'warehouse': re.compile(r"^[\w$]+$"),
+                'chunk': re.compile(r"^(?P<table>[\w$]+(?:\.[\w$]+)*)\.(?P<column>[\w$]+)\s+(?P<chunks>\d+)$")}
+
+# single pass lexer: comments and string literals (including $$ bodies) are
+# blanked out in one scan, what is left is code split into statements on ';'
+SKIP         = re.compile(r"--[^\n]*|//[^\n]*|/\*[^*]*\*+(?:[^/*][^*]*\*+)*/"
+                          r"|'[^'\\]*(?:(?:\\.|'')[^'\\]*)*'"
+                          r"|\$\$[^$]*(?:\$(?!\$)[^$]*)*\$\$")
+SKIP_START   = re.compile(r"--|//|/\*|'|\$\$")
+NAME         = r'(?:"[^"]*"|[\w$][\w$-]*)(?:\s*\.\s*(?:"[^"]*"|[\w$][\w$-]*))*'
+WORD         = re.compile(NAME + r'|\(')
+REFERENCE    = re.compile(r'\s+(' + NAME + ')')
+NAME_DOTS    = re.compile(r'\s*\.\s*')
+NAME_PART    = re.compile(r'"(?:[^"]|"")*"|[^."]+')
+
+OBJECT_TYPES = {'PROCEDURE', 'FUNCTION', 'TABLE', 'EXTERNAL TABLE', 'SEQUENCE', 'VIEW',
+                'MATERIALIZED VIEW', 'FILE FORMAT', 'STAGE', 'PIPE', 'STREAM', 'TASK'}
+DDL_VERBS    = {'CREATE', 'DROP', 'ALTER'}
+AUTOCOMMIT_VERBS = DDL_VERBS | {'UNDROP', 'GRANT', 'REVOKE', 'COMMENT'}
+MODIFIERS    = {'OR REPLACE': 'OR_REPLACE', 'IF NOT EXISTS': 'IF_NOT_EXISTS',
+                'IF EXISTS': 'IF_EXISTS', 'LOCAL': 'LOCAL', 'GLOBAL': 'GLOBAL',
+                'TEMP': 'TEMPORARY', 'TEMPORARY': 'TEMPORARY', 'VOLATILE': 'VOLATILE',
+                'TRANSIENT': 'TRANSIENT', 'SECURE': 'SECURE', 'RECURSIVE': 'RECURSIVE'}
+REFERENCED_BY= ('from', 'join', 'into', 'update', 'using', 'clone', 'references')
+NOT_A_NAME   = {'SELECT', 'TABLE', 'LATERAL', 'VALUES', 'WITH'}
+HEAD_LENGTH  = 12
+
+StatementMeta = namedtuple('StatementMeta', 'verb o_type o_name modifiers references')
 
 _print_comment   = lambda x: cprint(x, 'green', attrs=['dark'], end='')
 _print_keyword   = lambda x: cprint(x.upper(), 'blue', end='')
@@ -48,33 +73,163 @@ def split_sql(sql):
     sql = sqlparse.format(sql, strip_comments=True)
     return sqlparse.split(sql)
 
+def parse_sql(sql):
+    """Returns StatementMeta for every statement in sql. The text is scanned
+       once, comments and string literals are skipped."""
+    statements = []
+    for code in SKIP.sub(' ', sql).split(';'):
+        head = []
+        for word in WORD.finditer(code):
+            head.append(word.group().upper())
+            if len(head) == HEAD_LENGTH:
+                break
+        if head:
+            statements.append(_statement_meta(head, _references(code)))
+    return statements
+
+def _first_create(sql):
+    """Returns StatementMeta (with no references) of the first CREATE
+       statement in sql, or None. Lexing stops as soon as its name is
+       known, so e.g. a long procedure body is not read."""
+    head, pos = [], 0
+    while True:
+        skip = SKIP_START.search(sql, pos)
+        for i, code in enumerate(sql[pos:skip.start() if skip else len(sql)].split(';')):
+            if i:
+                head = []
+            if len(head) < HEAD_LENGTH:
+                head += [word.group().upper() for word in islice(WORD.finditer(code), HEAD_LENGTH - len(head))]
+                # words after the name change neither the name nor modifiers
+                if head and head[0] == 'CREATE':
+                    meta = _statement_meta(head, [])
+                    if meta.o_name:
+                        return meta
+        if skip is None:
+            return None
+        # no CREATE name yet, skip the comment or string
+        matched = SKIP.match(sql, skip.start())
+        pos = matched.end() if matched else skip.start() + 1
+
+def _references(code):
+    """Returns names following FROM, JOIN, INTO etc. in order of appearance.
+       Keywords are located with str.find which is much faster than a
+       case-insensitive regex over long statements."""
+    lowered = code.lower()
+    found = []
+    for keyword in REFERENCED_BY:
+        i = lowered.find(keyword)
+        while i >= 0:
+            end = i + len(keyword)
+            if i == 0 or not (lowered[i-1].isalnum() or lowered[i-1] in '_$'):
+                name = REFERENCE.match(code, end)
+                if name:
+                    found.append((i, NAME_DOTS.sub('.', name.group(1).upper())))
+            i = lowered.find(keyword, end)
+    return [name for i, name in sorted(found)]
+
+def _statement_meta(head, references):
+    """Reads verb, object type, name and modifiers from statement's first words."""
+    verb, o_type, o_name, modifiers = head[0], None, None, set()
+    i = 1
+    while verb in DDL_VERBS and i < len(head):
+        three, two, word = ' '.join(head[i:i+3]), ' '.join(head[i:i+2]), head[i]
+        if three in MODIFIERS:
+            modifiers.add(MODIFIERS[three])
+            i += 3
+        elif two in MODIFIERS:
+            modifiers.add(MODIFIERS[two])
+            i += 2
+        elif word in MODIFIERS:
+            modifiers.add(MODIFIERS[word])
+            i += 1
+        elif o_type is None and two in OBJECT_TYPES:
+            o_type = two
+            i += 2
+        elif o_type is None and word in OBJECT_TYPES:
+            o_type = word
+            i += 1
+        else:
+            if o_type and word != '(':
+                o_name = NAME_DOTS.sub('.', word)
+            break
+
+    o_type = o_type.replace(' ', '_') if o_type else None
+    references = list(dict.fromkeys(r for r in references if r != o_name and r not in NOT_A_NAME))
+    return StatementMeta(verb, o_type, o_name, frozenset(modifiers), references)
+
+def split_sql_hints(sql):
+    """Splits SQL like split_sql and returns also statement hints as
+       {statement index: {hint: value}}. Hint lines apply to the statement
+       following them:
+
+         --.WAREHOUSE: NAME            run statement on the given warehouse
+         --.CHUNK: TABLE.COLUMN N      backfill in N chunks by COLUMN ranges"""
+    statements, hints = [], {}
+    pos, pending = 0, {}
+    for hint in STATEMENT_HINT.finditer(sql):
+        part = split_sql(sql[pos:hint.start()])
+        if part and pending:
+            hints[len(statements)], pending = pending, {}
+        statements += part
+        name, value = hint.group('hint').lower(), hint.group('value')
+        assert HINT_VALUE[name].match(value), f"Invalid hint: {hint.group(0).strip()}"
+        pending[name] = value.upper() if name == 'warehouse' else value
+        pos = hint.end()
+    part = split_sql(sql[pos:])
+    if part and pending:
+        hints[len(statements)] = pending
+    statements += part
+    return statements, hints
+
+def parse_chunk_hint(value):
+    """Returns (table, column, number of chunks) of a --.CHUNK hint value."""
+    spec = HINT_VALUE['chunk'].match(value)
+    assert spec and int(spec.group('chunks')) > 0, f"Invalid chunk hint: {value}"
+    return spec.group('table'), spec.group('column'), int(spec.group('chunks'))
+
+def log_statement_hints(statements, hints, default):
+    """Logs which statements are routed to a non-default warehouse or
+       backfilled in chunks."""
+    if not hints:
+        return
+    logger.info(f"Statement hints (default warehouse {default}):")
+    for i, hint in sorted(hints.items()):
+        statement = ' '.join(statements[i].split())
+        routing = ', '.join(f"{name} {value}" for name, value in sorted(hint.items()))
+        logger.info(f"  #{i + 1:<4} {routing:<30} {statement:.60}")
+
 def sql_meta(filename):
     dir_type = TYPE_DIR.search(filename)
     assert dir_type, (f"Can't find valid object type prefix\nin {filename}")
     dir_type = dir_type.group('dir_type')
 
     sql = get_file_contents(filename)
-    type_name = TYPE_NAME.search(sql)
-    assert type_name, (f"Can't find a valid SQL CREATE statement\nin {filename}")
+    create = _first_create(sql)
+    assert create, (f"Can't find a valid SQL CREATE statement\nin {filename}")
 
-    o_type = type_name.group('o_type').upper().replace(' ', '_')
-    o_name = type_name.group('o_name').upper()
+    o_type = create.o_type
+    o_name = create.o_name
+    modifiers = create.modifiers
 
     if dir_type.upper() != o_type:
         logger.warning(f"SQL CREATE {o_type} statement in folder named {dir_type}\nin{filename}")
     
     easy_ddl = False if o_type in ['TABLE', 'STREAM'] else True
+    if not easy_ddl:
+        # tables and streams: every statement of the file is checked
+        statements = parse_sql(sql)
+        creates = [st for st in statements if st.verb == 'CREATE' and st.o_name]
 
-    if not easy_ddl and not IF_NOT_EXISTS.search(sql):
+    if not easy_ddl and 'IF_NOT_EXISTS' not in modifiers:
         logger.debug(f"SQL CREATE {o_type} statement without 'IF NOT EXISTS' statement\nin {filename}")
     
-    assert easy_ddl or not OR_REPLACE.search(sql), (
+    assert easy_ddl or not any('OR_REPLACE' in st.modifiers for st in creates), (
             f"Dangerous SQL CREATE {o_type} statement with 'OR REPLACE' statement\nin {filename}")
     
-    assert easy_ddl or not DROP.search(sql), (
+    assert easy_ddl or not any(st.verb == 'DROP' and st.o_type for st in statements), (
             f"Dangerous SQL DROP {o_type} statement\nin {filename}")
 
-    if easy_ddl and not OR_REPLACE.search(sql):
+    if easy_ddl and 'OR_REPLACE' not in modifiers:
         logger.warning(f"SQL CREATE {o_type} statement without 'OR REPLACE' statement\nin {filename}")
     
     return (o_name, o_type, easy_ddl, sql)
@@ -89,6 +244,57 @@ def get_diff_sql(left, right, fromfile, tofile):
 
     return "--.DIFF: " + "--.DIFF: ".join(unified_diff(left, right, fromfile=fromfile, tofile=tofile))        
 
+def object_key(o_type, o_name) -> str:
+    """Returns TYPE#SCHEMA.NAME key (database part dropped, PUBLIC schema
+       assumed for unqualified names)."""
+    parts = [part.strip('"') for part in o_name.split('.')]
+    if len(parts) == 1:
+        parts.insert(0, 'PUBLIC')
+    return f"{o_type}#{'.'.join(parts[-2:])}".upper()
+
+def ddl_fingerprints(sql, strict=False):
+    """Returns {TYPE#SCHEMA.NAME: fingerprint} of CREATE statements in sql.
+       Fingerprint ignores comments, whitespace, the part up to object name
+       and OR REPLACE / IF NOT EXISTS. With strict=True returns None if sql
+       contains any other statement."""
+    fingerprints = {}
+    for statement in split_sql(sql):
+        meta = parse_sql(statement)
+        if not meta or meta[0].verb != 'CREATE' or not meta[0].o_name:
+            if strict:
+                return None
+            continue
+        meta = meta[0]
+        short_name = re.escape(meta.o_name.split('.')[-1].strip('"'))
+        body = re.split(r'(?<![\w$])"?' + short_name + r'"?(?![\w$])', statement,
+                        maxsplit=1, flags=re.I)[-1]
+        modifiers = sorted(meta.modifiers - {'OR_REPLACE', 'IF_NOT_EXISTS'})
+        fingerprints[object_key(meta.o_type, meta.o_name)] = hexDigest(
+                ' '.join(modifiers + body.split()))
+    return fingerprints
+
+def content_hash(sql) -> str:
+    """Returns hash of SQL ignoring comments and whitespace."""
+    return hexDigest(' '.join(' '.join(split_sql(sql)).split()))
+
+def sql_string(value) -> str:
+    """Escapes value for a single quoted SQL string literal."""
+    return str(value).replace("'", "''")
+
+def quote_identifier(identifier) -> str:
+    """Returns identifier as a double quoted SQL identifier."""
+    return '"' + identifier.replace('"', '""') + '"'
+
+def suffixed_name(o_name, suffix) -> str:
+    """Returns (qualified) object name with suffix added to the object part,
+       a quoted part stays quoted."""
+    *qualifier, name = NAME_PART.findall(o_name)
+    if name.startswith('"'):
+        name = quote_identifier(name[1:-1].replace('""', '"') + suffix)
+    else:
+        name += suffix
+    return '.'.join(qualifier + [name])
+
 def statement_cleanup(statement) -> str:
     """ Cleans up SQL statement. """
     statement = sqlparse.format(statement, strip_comments=True, keyword_case='lower',
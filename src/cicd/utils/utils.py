@@ -18,7 +18,11 @@ def remove_file(filename):
 
 def yes_or_no(question):
     while "the answer is invalid":
-        reply = str(input(question+' (y/n): ')).lower().strip()
+        try:
+            reply = str(input(question+' (y/n): ')).lower().strip()
+        except EOFError:
+            # no terminal to ask (e.g. command run by daemon)
+            return False
         if reply[:1] == 'y':
             return True
         if reply[:1] == 'n':
@@ -0,0 +1,11 @@
+import os
+import tempfile
+
+from cicd.utils.config import Config
+
+# class attributes read config on import, so the user connection file has
+# to be in place before test modules import cicd modules
+_home = tempfile.mkdtemp()
+Config.CONN_INI = os.path.join(_home, '.snowflake-cicd.ini')
+with open(Config.CONN_INI, 'w') as conn_ini:
+    conn_ini.write("[default]\nuser=tester\nproduction_db=DWH\nstaging_db=DWH_STAGING\n")
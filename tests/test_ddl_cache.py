@@ -0,0 +1,32 @@
+from pathlib import Path
+
+import pytest
+
+from cicd.utils.ddl_cache import DDLCache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(DDLCache, 'CACHE_DIR', str(tmp_path / '.ddl_cache'))
+    return DDLCache()
+
+
+def disk_size(cache):
+    return sum(path.stat().st_size for path in Path(cache.CACHE_DIR).glob('*/*.json'))
+
+
+def test_replaced_entry_counted_once(cache):
+    cache.put('DB', 'VIEW#PUBLIC.V', 1, 'CREATE VIEW V AS SELECT 1;')
+    # size is unknown again (e.g. after clear of another database)
+    cache.clear('OTHER')
+    cache.put('DB', 'VIEW#PUBLIC.V', 2, 'CREATE VIEW V AS SELECT 2;')
+    assert cache._size == disk_size(cache)
+    cache.put('DB', 'VIEW#PUBLIC.V', 3, 'CREATE VIEW V AS SELECT 3;')
+    assert cache._size == disk_size(cache)
+
+
+def test_entry_invalid_once_altered(cache):
+    cache.put('DB', 'PROCEDURE#PUBLIC.P()', 1, 'CREATE PROCEDURE P() ...')
+    assert cache.get('DB', 'PROCEDURE#PUBLIC.P()', 1) == 'CREATE PROCEDURE P() ...'
+    assert cache.get('DB', 'PROCEDURE#PUBLIC.P()', 2) is None
+    assert cache.get('DB', 'PROCEDURE#PUBLIC.P(X NUMBER)', 1) is None
@@ -0,0 +1,97 @@
+from collections import namedtuple
+
+import pytest
+from snowflake.connector.errors import ProgrammingError
+
+from cicd.utils.journal import Journal
+from cicd.utils.snowflake import sf
+
+
+Column = namedtuple('Column', 'name type_code')
+
+
+class FakeCursor():
+    """Cursor of FakeConnection, statements containing `fail` raise."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.sfqid = None
+        self.rowcount = 0
+
+    def execute(self, sql):
+        self.conn.executed.append(sql)
+        self.sfqid = f"q{len(self.conn.executed)}"
+        if self.conn.fail in sql:
+            raise ProgrammingError(msg=f"SQL compilation error: {sql}", sfqid=self.sfqid)
+
+    def fetchone(self):
+        return ('2026-01-01 00:00:00.000000000 +0000',)
+
+    def fetchall(self):
+        return []
+
+    def describe(self, sql):
+        # key columns of every table are VARCHAR (type code 2)
+        return [Column('KEY', 2)]
+
+
+class FakeConnection():
+
+    def __init__(self, fail):
+        self.fail = fail
+        self.executed = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.executed.append('ROLLBACK')
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    conn = FakeConnection(fail='CREATE VIEW BROKEN')
+    monkeypatch.setattr(sf, 'session', lambda branch, db=None: conn)
+    monkeypatch.setattr(sf, 'release_session', lambda conn: None)
+    return conn
+
+
+STATEMENTS = ["INSERT INTO PUBLIC.EVENTS VALUES (1);",
+              "UPDATE PUBLIC.EVENTS SET ID = 2;",
+              "CREATE VIEW BROKEN AS SELECT * FROM NOWHERE;",
+              "INSERT INTO PUBLIC.EVENTS VALUES (3);"]
+
+
+def test_failed_ddl_after_dml_checkpoints_committed_prefix(conn):
+    with pytest.raises(RuntimeError):
+        sf.perform_statements(STATEMENTS, 'feature', db='_DEV_FEATURE')
+
+    # DML before the DDL is committed explicitly before the DDL runs
+    ddl = conn.executed.index(STATEMENTS[2])
+    assert 'COMMIT;' in conn.executed[conn.executed.index(STATEMENTS[1]):ddl]
+    assert Journal('_DEV_FEATURE', STATEMENTS, connect=None).resume_point() == 2
+
+
+def test_resume_skips_committed_dml(conn):
+    with pytest.raises(RuntimeError):
+        sf.perform_statements(STATEMENTS, 'feature', db='_DEV_FEATURE')
+    conn.fail = 'NOTHING FAILS'
+    conn.executed.clear()
+
+    sf.perform_statements(STATEMENTS, 'feature', db='_DEV_FEATURE', resume=True)
+
+    assert STATEMENTS[0] not in conn.executed and STATEMENTS[1] not in conn.executed
+    assert STATEMENTS[2] in conn.executed and STATEMENTS[3] in conn.executed
+
+
+@pytest.mark.parametrize('chunked, error', [
+    ("INSERT INTO PUBLIC.EVENTS SELECT * FROM PUBLIC.RAW;", "placeholder"),
+    ("INSERT INTO PUBLIC.EVENTS SELECT * FROM PUBLIC.RAW WHERE {{CHUNK}};", "of type TEXT"),
+])
+def test_chunk_hints_checked_before_first_statement(conn, chunked, error):
+    statements = [STATEMENTS[0], chunked]
+    hints = {1: {'chunk': 'PUBLIC.RAW.KEY 4'}}
+    with pytest.raises(RuntimeError, match=error):
+        sf.perform_statements(statements, 'feature', db='_DEV_FEATURE', hints=hints)
+    assert STATEMENTS[0] not in conn.executed
@@ -0,0 +1,100 @@
+import json
+from time import time
+
+import pytest
+
+from cicd.utils.query_stats import QueryStats
+
+
+def history_row(query_id, warehouse='COMPUTE_WH', elapsed=1000):
+    """QUERY_HISTORY row as returned by query_history query."""
+    return (query_id, warehouse, 10, 20, elapsed - 30, 1024, elapsed)
+
+
+class CannedHistory():
+    """Stand-in for sf.query_history serving canned rows per database."""
+
+    def __init__(self, rows, failing=()):
+        self.rows = rows
+        self.failing = set(failing)
+        self.calls = []
+
+    def __call__(self, db, query_ids, since):
+        self.calls.append((db, sorted(query_ids)))
+        if db in self.failing:
+            raise RuntimeError(f"Database '{db}' does not exist or not authorized.")
+        return [row for row in self.rows if row[0] in query_ids]
+
+
+@pytest.fixture
+def stats(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return QueryStats()
+
+
+def record(stats, db, query_id, i=0, run_on=None):
+    stats.record(db, query_id, QueryStats.tag('0123456789abcdef', 'releases/r1.sql', i))
+    if run_on is not None:
+        pending = stats.pending()
+        pending[-1]['run_on'] = run_on
+        with open(QueryStats.PENDING, 'w') as pending_file:
+            pending_file.writelines(json.dumps(query) + '\n' for query in pending)
+
+
+def test_full_harvest(stats):
+    record(stats, 'DWH', 'q1', 0)
+    record(stats, 'DWH', 'q2', 1)
+    fetch = CannedHistory([history_row('q1'), history_row('q2', 'LOAD_XL', 5000)])
+
+    harvested = stats.harvest(fetch)
+
+    assert fetch.calls == [('DWH', ['q1', 'q2'])]
+    assert [row['query_id'] for row in harvested] == ['q1', 'q2']
+    assert harvested[1]['warehouse'] == 'LOAD_XL'
+    assert harvested[1]['tag'] == {'cicd': '0123456789ab', 'file': 'releases/r1.sql', 'statement': 2}
+    assert stats.pending() == []
+    assert stats.last() == harvested
+
+
+def test_partial_harvest_keeps_missing_pending(stats):
+    record(stats, 'DWH', 'q1')
+    record(stats, 'DWH', 'q2')
+
+    harvested = stats.harvest(CannedHistory([history_row('q1')]))
+
+    assert [row['query_id'] for row in harvested] == ['q1']
+    assert [query['query_id'] for query in stats.pending()] == ['q2']
+
+    harvested = stats.harvest(CannedHistory([history_row('q2')]))
+    assert [row['query_id'] for row in harvested] == ['q2']
+    assert stats.pending() == []
+
+
+def test_failing_database_does_not_block_others(stats):
+    record(stats, '_DEV_DROPPED', 'q1')
+    record(stats, 'DWH', 'q2')
+    fetch = CannedHistory([history_row('q1'), history_row('q2')], failing={'_DEV_DROPPED'})
+
+    harvested = stats.harvest(fetch)
+
+    assert [row['query_id'] for row in harvested] == ['q2']
+    assert [query['query_id'] for query in stats.pending()] == ['q1']
+
+
+def test_queries_past_retention_expire(stats):
+    record(stats, 'DWH', 'old', run_on=time() - QueryStats.RETENTION - 60)
+    record(stats, 'DWH', 'new')
+
+    assert stats.harvest(CannedHistory([])) == []
+    assert [query['query_id'] for query in stats.pending()] == ['new']
+
+
+def test_tag_escaping():
+    label = "releases/it's \"quoted\" \\ file.sql"
+    tag = QueryStats.tag('0123456789abcdef', label, 4, chunk=2)
+
+    assert json.loads(tag) == {'cicd': '0123456789ab', 'file': label, 'statement': 5, 'chunk': 3}
+    sql = QueryStats.set_tag_sql(tag)
+    assert sql.startswith("ALTER SESSION SET QUERY_TAG = '") and sql.endswith("';")
+    literal = sql[len("ALTER SESSION SET QUERY_TAG = '"):-len("';")]
+    assert "''" in literal and literal.replace("''", "'") == tag
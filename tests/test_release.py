@@ -0,0 +1,100 @@
+import pytest
+
+from cicd.utils.dwhrepo import repo
+from cicd.utils.release import release
+from cicd.utils.rollback import RollbackPoint
+from cicd.utils.snowflake import sf
+from cicd.utils.sql import ddl_fingerprints
+
+
+VIEW = "CREATE OR REPLACE VIEW PUBLIC.ACTIVE_USERS AS SELECT * FROM PUBLIC.USERS;\n"
+INCLUDE = "-- [M] INCLUDED:model/views/active_users.sql #0123456789abcdef\n"
+
+
+@pytest.fixture
+def server_ddls(monkeypatch):
+    monkeypatch.setattr(repo, 'get_file_contents_by_commit', lambda filename, commit: VIEW)
+    return ddl_fingerprints(VIEW)
+
+
+def test_unchanged_definition_skipped(server_ddls):
+    sql = release.release_file_to_sql(INCLUDE, server_ddls)
+    assert VIEW not in sql
+    assert "-- skipped, definition on the server is identical" in sql
+
+
+def test_include_after_drop_not_skipped(server_ddls):
+    sql = release.release_file_to_sql("DROP VIEW PUBLIC.ACTIVE_USERS;\n" + INCLUDE, server_ddls)
+    assert VIEW in sql
+
+
+def test_include_after_alter_of_referenced_table_not_skipped(server_ddls):
+    sql = release.release_file_to_sql("ALTER TABLE PUBLIC.USERS ADD COLUMN EMAIL VARCHAR;\n" + INCLUDE,
+                                      server_ddls)
+    assert VIEW in sql
+
+
+def test_include_after_earlier_release_file_not_skipped(server_ddls):
+    sql = release.release_file_to_sql(INCLUDE, server_ddls,
+                                      applied=["ALTER VIEW ACTIVE_USERS RENAME TO OLD_USERS;\n"])
+    assert VIEW in sql
+
+
+@pytest.fixture
+def release_files(tmp_path, monkeypatch):
+    """Writes release files INCLUDing model/views/events.sql at commits
+       (in order), commit of an INCLUDE selects the view name it creates."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(repo, 'get_file_contents_by_commit',
+            lambda filename, commit: f"CREATE OR REPLACE VIEW PUBLIC.{commit} AS SELECT 1 AS ID;\n")
+    def write(*commits):
+        files = []
+        for i, commit in enumerate(commits):
+            files.append(f"r{i}.sql")
+            (tmp_path / files[-1]).write_text(f"-- [M] INCLUDED:model/views/events.sql #{commit}\n")
+        return files
+    return write
+
+
+def test_include_superseded_by_same_object(release_files):
+    files = release_files('EVENTS', 'EVENTS')
+    assert release.superseded_includes(files) == {'r0.sql': {0}}
+
+
+def test_include_not_superseded_by_renamed_object(release_files):
+    files = release_files('EVENTS', 'ALL_EVENTS')
+    assert release.superseded_includes(files) == {}
+
+
+@pytest.fixture
+def rollback_point(tmp_path, monkeypatch):
+    """Rollback point of a release that touched a quoted table and a view,
+       statements run by rollback are collected, the view can't be restored."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(release, 'OBJECT_HASH_TABLE', '')
+    monkeypatch.setattr(sf, 'get_db_name', lambda branch: '_DEV_FEATURE')
+    monkeypatch.setattr(release, '_get_definition', lambda o_type, o_name, commit: None)
+    executed = []
+    def run(sql, branch='main', db=None):
+        executed.append(sql)
+        if sql.startswith('SELECT COMMIT'):
+            return [('0123456789abcdef',)]
+        if sql.startswith('DROP VIEW'):
+            raise RuntimeError("Insufficient privileges to operate on view 'EVENTS_V'")
+        return [('ok',)]
+    monkeypatch.setattr(sf, 'run_single_statament', run)
+    point = RollbackPoint('_DEV_FEATURE')
+    point.save({'db': '_DEV_FEATURE', 'run': None, 'timestamp': '2026-01-01 00:00:00.000 +0000',
+                'objects': [{'type': 'TABLE', 'name': 'PUBLIC."Events"', 'verbs': ['INSERT']},
+                            {'type': 'VIEW', 'name': 'PUBLIC.EVENTS_V', 'verbs': ['CREATE']}]})
+    return point, executed
+
+
+def test_rollback_keeps_history_of_failed_objects(rollback_point):
+    point, executed = rollback_point
+    with pytest.raises(RuntimeError, match='EVENTS_V'):
+        release.rollback()
+
+    assert 'CREATE TABLE PUBLIC."Events_ROLLBACK" CLONE PUBLIC."Events"' in executed[2]
+    assert not any(sql.startswith('DELETE FROM') for sql in executed)
+    assert [obj['name'] for obj in point.load()['objects']] == ['PUBLIC.EVENTS_V']